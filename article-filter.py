@@ -21,19 +21,79 @@
 # # I only want to see articles by Mark.
 # feed 30m http://boingboing.net/rss.xml
 #   filter hide ; show author "^Mark"
+#
+# The tests in an entry can also be combined into a boolean expression using
+# "and", "or", "not" and parentheses; tests next to each other are ANDed as
+# above. As well as field-name/regexp pairs, these tests are available:
+#
+#   exists FIELD        the article has the field
+#   since YYYY-MM-DD    the article is dated on or after the given day
+#   until YYYY-MM-DD    the article is dated on or before the given day
+#
+# (Articles without a date use the time they were first seen.) Keywords and
+# parentheses must be separated by spaces, and aren't treated specially if
+# they're quoted. For example:
+#
+# # Hide anything from before 2013 that isn't about cats or dogs.
+# feed 30m http://boingboing.net/rss.xml
+#   filter hide until 2012-12-31 and not ( title "(?i)cat" or title "(?i)dog" )
+#
+# The tests in an "and" or "or" are reordered as rawdog runs so that the
+# cheapest tests most likely to decide the result are tried first. To see how
+# often each entry matched and how long it took, set "filterstats true" in the
+# main config file; a report will be printed when rawdog finishes.
+#
+# Some regular expressions, such as "(a+)+$" or "(a|aa)+$", can take an
+# extremely long time to match some text. To stop one of these from holding up
+# rawdog, all the searches are done by a separate worker process, which is
+# killed if an article's searches take longer than the time allowed (on
+# systems that support fork). The article then gets a default verdict, and a
+# message is logged. Expressions with nested repeats like "(a+)+" are also
+# reported when rawdog starts; this check can't spot every slow expression
+# (for example, repeated alternatives that overlap, like "(a|aa)+"), but the
+# time limit applies to them all. This is controlled by defines in the main
+# config file, which are shared with the feedgrep plugin:
+#
+#   define regexbudget SECONDS      time allowed per article (default 2; 0
+#                                   means no limit)
+#   define regexdefault show|hide   verdict for articles that run out of time
+#                                   (default show)
+#   define regexhazards guard|reject
+#                                   whether to reject expressions with nested
+#                                   repeats as configuration errors
+#
+# The code for this is duplicated in feedgrep.py, so that each plugin can be
+# used on its own; the two copies (from nested_repeat to RegexGuard) are
+# identical, and changes to one should be made to the other as well.
 
-import rawdoglib.plugins, sys, re
+# Each feed's filter is compiled once into a program of precompiled regular
+# expressions, which is reused until the feed's filter changes. Errors in
+# filters are reported when rawdog starts. An entry that refers to a field
+# the article doesn't have doesn't match. The first time one of an article's
+# regexps is needed, all the searches its filter might do are sent to the
+# worker process together.
+#
+# Whether each article is hidden is decided when it's added or updated, and
+# remembered in rawdog's state along with a fingerprint of the filter that
+# decided it, so writing output doesn't need to run the filters again unless
+# they've changed.
 
-def parse_quoted(s):
+import rawdoglib.plugins, rawdoglib.rawdog, re, hashlib, time
+import cPickle, os, select, signal, sre_constants, sre_parse, struct, threading
+
+def parse_tokens(s):
 	"""Parse a string that contains a number of space-separated items,
 	which may optionally be surrounded by quotes, into a list of
-	strings."""
+	(string, quoted) pairs."""
 	l = []
 	i = 0
 	while i < len(s):
-		while s[i] == ' ':
+		while i < len(s) and s[i] == ' ':
 			i += 1
-		if s[i] == '"':
+		if i == len(s):
+			break
+		quoted = (s[i] == '"')
+		if quoted:
 			b = i + 1
 			e = s.find('"', i + 1)
 		else:
@@ -41,55 +101,590 @@ def parse_quoted(s):
 			e = s.find(' ', i + 1)
 		if e == -1:
 			e = len(s)
-		l.append(s[b:e])
+		l.append((s[b:e], quoted))
 		i = e + 1
 	return l
 
-def match_article(rawdog, article):
-	hide = False
+def parse_quoted(s):
+	"""Parse a string that contains a number of space-separated items,
+	which may optionally be surrounded by quotes, into a list of
+	strings."""
+	return [v for (v, quoted) in parse_tokens(s)]
 
-	fargs = rawdog.feeds[article.feed].args
-	if "filter" in fargs:
-		filter = fargs["filter"]
-		vs = parse_quoted(filter)
-		i = 0
-		while i < len(vs):
-			if vs[i] not in ("show", "hide"):
-				print >>sys.stderr, "Expected show or hide but got " + vs[i] + " in filter: " + filter
+def nested_repeat(items, outer=False):
+	"""Return True if a parsed regular expression contains an
+	unbounded repeat inside another repeat, such as "(a+)+"."""
+	for op, av in items:
+		if op in (sre_constants.MAX_REPEAT, sre_constants.MIN_REPEAT):
+			(lo, hi, sub) = av
+			if outer and hi == sre_constants.MAXREPEAT:
 				return True
-			value = (vs[i] == "hide")
-			matched = True
-			i += 1
-			while i < len(vs) and vs[i] != ";":
-				info = article.entry_info
-				if i + 1 >= len(vs):
-					print >>sys.stderr, "Expected regexp at end of filter: " + filter
-					return True
-				if not vs[i] in info:
-					print >>sys.stderr, "Bad field name " + vs[i] + " in filter: " + filter
-					return True
-				try:
-					m = re.search(vs[i + 1], info[vs[i]])
-					if m is None:
-						matched = False
-				except re.error:
-					print >>sys.stderr, "Bad regular expression " + vs[i + 1] + " in filter: " + filter
+			if nested_repeat(sub, outer or hi > 1):
+				return True
+			continue
+		if isinstance(av, sre_parse.SubPattern):
+			av = [av]
+		elif not isinstance(av, (list, tuple)):
+			continue
+		for sub in av:
+			if isinstance(sub, list):
+				subs = sub
+			else:
+				subs = [sub]
+			for sub in subs:
+				if isinstance(sub, sre_parse.SubPattern) and nested_repeat(sub, outer):
 					return True
-				i += 2
-			if matched:
-				hide = value
-			if i < len(vs) and vs[i] == ";":
-				i += 1
+	return False
+
+def is_hazardous(pattern, reflags=0):
+	"""Return True if pattern may need exponential time to match."""
+	try:
+		return nested_repeat(sre_parse.parse(pattern, reflags))
+	except (re.error, sre_constants.error):
+		return False
+
+def write_message(fd, obj):
+	data = cPickle.dumps(obj, 2)
+	data = struct.pack(">I", len(data)) + data
+	while data != "":
+		data = data[os.write(fd, data):]
+
+def read_exactly(fd, size, deadline):
+	"""Read size bytes from fd, returning None at end of file or if the
+	deadline (if it isn't None) passes first."""
+	chunks = []
+	while size > 0:
+		if deadline is not None:
+			remaining = deadline - time.time()
+			if remaining <= 0:
+				return None
+			if select.select([fd], [], [], remaining)[0] == []:
+				return None
+		chunk = os.read(fd, min(size, 65536))
+		if chunk == "":
+			return None
+		chunks.append(chunk)
+		size -= len(chunk)
+	return "".join(chunks)
+
+def read_message(fd, deadline=None):
+	header = read_exactly(fd, 4, deadline)
+	if header is None:
+		return None
+	data = read_exactly(fd, struct.unpack(">I", header)[0], deadline)
+	if data is None:
+		return None
+	return cPickle.loads(data)
+
+def search_texts(regexes, texts):
+	"""Return True if any of regexes matches any of texts."""
+	for text in texts:
+		for regex in regexes:
+			if regex.search(text) is not None:
+				return True
+	return False
+
+class RegexWorker:
+	"""A child process that runs regular expression searches, so that a
+	search that's taking too long can be stopped by killing it. It's
+	started when it's first needed, and again after it's been killed."""
+
+	def __init__(self):
+		self.pid = None
+		self.lock = threading.Lock()
+
+	def start(self):
+		(req_r, req_w) = os.pipe()
+		(resp_r, resp_w) = os.pipe()
+		pid = os.fork()
+		if pid == 0:
+			code = 1
+			try:
+				os.close(req_w)
+				os.close(resp_r)
+				self.serve(req_r, resp_w)
+				code = 0
+			finally:
+				os._exit(code)
+		os.close(req_r)
+		os.close(resp_w)
+		(self.pid, self.req, self.resp) = (pid, req_w, resp_r)
+
+	def serve(self, req, resp):
+		regexes = {}
+		while True:
+			jobs = read_message(req)
+			if jobs is None:
+				return
+			results = []
+			for (patterns, texts) in jobs:
+				for key in patterns:
+					if key not in regexes:
+						regexes[key] = re.compile(key[0], key[1])
+				results.append(search_texts([regexes[key] for key in patterns], texts))
+			write_message(resp, results)
+
+	def stop(self):
+		if self.pid is None:
+			return
+		os.close(self.req)
+		os.close(self.resp)
+		try:
+			os.kill(self.pid, signal.SIGKILL)
+		except OSError:
+			pass
+		os.waitpid(self.pid, 0)
+		self.pid = None
+
+	def search(self, jobs, deadline):
+		"""Run a list of (regexes, texts) searches in one go, returning a
+		list of whether each matched, or None if they didn't finish
+		before the deadline."""
+		self.lock.acquire()
+		try:
+			if self.pid is None:
+				self.start()
+			results = None
+			try:
+				write_message(self.req, [([(r.pattern, r.flags) for r in regexes], texts)
+				                         for (regexes, texts) in jobs])
+				results = read_message(self.resp, deadline)
+			except (OSError, IOError):
+				pass
+			if results is None:
+				self.stop()
+			return results
+		finally:
+			self.lock.release()
+
+worker = RegexWorker()
+
+class RegexTimeout(Exception):
+	pass
+
+# The guard settings, from the regexbudget, regexdefault and regexhazards
+# defines.
+guard_budget = 2.0
+guard_hide = False
+guard_reject = False
+
+def read_guard_options(config):
+	global guard_budget, guard_hide, guard_reject
+	defines = config["defines"]
+	try:
+		guard_budget = float(defines.get("regexbudget", "2"))
+	except ValueError:
+		raise rawdoglib.rawdog.ConfigError("bad regexbudget define: " + defines["regexbudget"])
+	guard_hide = (defines.get("regexdefault", "show") == "hide")
+	guard_reject = (defines.get("regexhazards", "guard") == "reject")
+
+class RegexGuard:
+	"""Runs the searches for one article within the time budget."""
+
+	def __init__(self):
+		if guard_budget > 0 and hasattr(os, "fork"):
+			self.deadline = time.time() + guard_budget
+		else:
+			self.deadline = None
+
+	def search(self, jobs):
+		"""Run a list of (regexes, texts) searches, returning a list of
+		whether any of each one's regexes matched any of its texts, and
+		raising RegexTimeout if the budget runs out. All the searches
+		are sent to the worker together."""
+		if self.deadline is None:
+			return [search_texts(regexes, texts) for (regexes, texts) in jobs]
+		if jobs == []:
+			return []
+		if self.deadline <= time.time():
+			raise RegexTimeout()
+		results = worker.search(jobs, self.deadline)
+		if results is None:
+			raise RegexTimeout()
+		return results
+
+def article_time(article):
+	if article.date is not None:
+		return article.date
+	return article.added
+
+def make_match(field, regexp):
+	def test(article, info, searches):
+		return searches.found(field, regexp)
+	return test
+
+def make_exists(field):
+	def test(article, info, searches):
+		return field in info
+	return test
+
+def make_since(start):
+	def test(article, info, searches):
+		return article_time(article) >= start
+	return test
 
+def make_until(end):
+	def test(article, info, searches):
+		return article_time(article) < end
+	return test
+
+def make_not(term):
+	def test(article, info, searches):
+		return not term(article, info, searches)
+	return test
+
+def make_true():
+	def test(article, info, searches):
+		return True
+	return test
+
+# How often to reorder the terms of an "and" or "or".
+reorder_interval = 64
+
+def make_adaptive(terms, want):
+	"""Return a test that's (not want) as soon as any of terms is (not
+	want), and otherwise want: an "and" if want is True, and an "or" if
+	it's False. The terms are periodically reordered so that those with
+	the lowest cost per decisive result are tried first."""
+	# Each term is [test, evaluations, decisive results, total time].
+	stats = [[term, 0, 0, 0.0] for term in terms]
+	calls = [0]
+
+	def rank(stat):
+		# Laplace-smoothed probability that the term decides the
+		# result.
+		p = (stat[2] + 1.0) / (stat[1] + 2.0)
+		cost = stat[3] / max(stat[1], 1)
+		return cost / p
+
+	def test(article, info, searches):
+		calls[0] += 1
+		if calls[0] % reorder_interval == 0:
+			stats.sort(key=rank)
+		for stat in stats:
+			start = time.time()
+			result = stat[0](article, info, searches)
+			stat[1] += 1
+			stat[3] += time.time() - start
+			if result != want:
+				stat[2] += 1
+				return not want
+		return want
+	return test
+
+class Rule:
+	"""A show or hide entry in a filter, with statistics about its use."""
+	def __init__(self, text, hide, test, hazards, searches):
+		self.text = text
+		self.hide = hide
+		self.test = test
+		self.hazards = hazards
+		# The (field, regexp) pairs that test may search for.
+		self.searches = searches
+		self.evaluations = 0
+		self.hits = 0
+		self.time = 0.0
+
+	def match(self, article, info, searches):
+		start = time.time()
+		result = self.test(article, info, searches)
+		self.time += time.time() - start
+		self.evaluations += 1
+		if result:
+			self.hits += 1
+		return result
+
+class FilterParser:
+	"""Parser for the filter language, producing a list of Rules."""
+
+	keywords = ("show", "hide", ";", "and", "or", "not", "(", ")",
+	            "exists", "since", "until")
+
+	def __init__(self, filter):
+		self.filter = filter
+		self.tokens = parse_tokens(filter)
+		self.pos = 0
+		self.hazards = []
+		self.searches = []
+
+	def error(self, msg):
+		raise rawdoglib.rawdog.ConfigError("article-filter: " + msg + " in filter: " + self.filter)
+
+	def peek(self):
+		"""Return the next token if it's an unquoted keyword, "" if it's
+		something else, or None at the end."""
+		if self.pos >= len(self.tokens):
+			return None
+		(v, quoted) = self.tokens[self.pos]
+		if not quoted and v in self.keywords:
+			return v
+		return ""
+
+	def next(self, what):
+		if self.pos >= len(self.tokens):
+			self.error("Expected " + what + " at end of filter")
+		v = self.tokens[self.pos][0]
+		self.pos += 1
+		return v
+
+	def parse_date(self, day):
+		try:
+			return time.mktime(time.strptime(day, "%Y-%m-%d"))
+		except ValueError:
+			self.error("Bad date " + day)
+
+	def parse(self):
+		program = []
+		while self.peek() is not None:
+			start = self.pos
+			self.hazards = []
+			self.searches = []
+			kind = self.next("show or hide")
+			if kind not in ("show", "hide"):
+				self.error("Expected show or hide but got " + kind)
+			if self.peek() in (None, ";"):
+				test = make_true()
+			else:
+				test = self.parse_or()
+			if self.peek() not in (None, ";"):
+				self.error("Unexpected " + self.next(""))
+			text = " ".join([v for (v, quoted) in self.tokens[start:self.pos]])
+			program.append(Rule(text, kind == "hide", test, self.hazards,
+			                    self.searches))
+			if self.peek() == ";":
+				self.pos += 1
+		return program
+
+	def parse_or(self):
+		terms = [self.parse_and()]
+		while self.peek() == "or":
+			self.pos += 1
+			terms.append(self.parse_and())
+		if len(terms) == 1:
+			return terms[0]
+		return make_adaptive(terms, False)
+
+	def parse_and(self):
+		terms = [self.parse_unary()]
+		while self.peek() not in (None, ";", "or", ")"):
+			if self.peek() == "and":
+				self.pos += 1
+			terms.append(self.parse_unary())
+		if len(terms) == 1:
+			return terms[0]
+		return make_adaptive(terms, True)
+
+	def parse_unary(self):
+		k = self.peek()
+		if k == "not":
+			self.pos += 1
+			return make_not(self.parse_unary())
+		elif k == "(":
+			self.pos += 1
+			test = self.parse_or()
+			if self.next(")") != ")":
+				self.error("Expected )")
+			return test
+		elif k == "exists":
+			self.pos += 1
+			return make_exists(self.next("field name"))
+		elif k == "since":
+			self.pos += 1
+			return make_since(self.parse_date(self.next("date")))
+		elif k == "until":
+			self.pos += 1
+			return make_until(self.parse_date(self.next("date")) + 24 * 60 * 60)
+		elif k == "":
+			field = self.next("field name")
+			pattern = self.next("regexp")
+			try:
+				regexp = re.compile(pattern)
+			except re.error:
+				self.error("Bad regular expression " + pattern)
+			if is_hazardous(pattern):
+				if guard_reject:
+					self.error("Regular expression with nested repeats " + pattern)
+				self.hazards.append(pattern)
+			self.searches.append((field, regexp))
+			return make_match(field, regexp)
+		else:
+			self.error("Unexpected " + self.next(""))
+
+def compile_filter(filter):
+	"""Compile a filter string into a program: a list of Rules."""
+	return FilterParser(filter).parse()
+
+def field_text(value):
+	"""Return the text of an entry field to match against."""
+	if isinstance(value, basestring):
+		return value
+	elif isinstance(value, dict):
+		return value.get("value", "")
+	elif isinstance(value, list):
+		return " ".join([field_text(v) for v in value])
+	else:
+		return unicode(value)
+
+# Maps feed URLs to (filter string, program).
+programs = {}
+
+def get_program(url, fargs):
+	"""Return the compiled filter program for a feed, or None if it
+	doesn't have a filter."""
+	if "filter" not in fargs:
+		return None
+	filter = fargs["filter"]
+	cached = programs.get(url)
+	if cached is None or cached[0] != filter:
+		cached = (filter, compile_filter(filter))
+		programs[url] = cached
+	return cached[1]
+
+class ArticleSearches:
+	"""The regexp searches that a filter program may need for one
+	article. The first time one of them is needed, they're all sent to
+	the guard together, so the worker process is only asked once."""
+	def __init__(self, program, info):
+		self.info = info
+		self.keys = []
+		for rule in program:
+			for key in rule.searches:
+				if key[0] in info and key not in self.keys:
+					self.keys.append(key)
+		self.guard = RegexGuard()
+		self.results = None
+
+	def found(self, field, regexp):
+		"""Return True if regexp matches the article's field."""
+		if field not in self.info:
+			return False
+		if self.results is None:
+			jobs = [([r], [field_text(self.info[f])]) for (f, r) in self.keys]
+			self.results = dict(zip(self.keys, self.guard.search(jobs)))
+		return self.results[(field, regexp)]
+
+def run_program(program, article):
+	# The last matching rule wins, so try them from the end.
+	info = article.entry_info
+	searches = ArticleSearches(program, info)
+	for i in xrange(len(program) - 1, -1, -1):
+		rule = program[i]
+		if rule.match(article, info, searches):
+			return rule.hide
+	return False
+
+def get_verdicts(rawdog):
+	"""Return the dict mapping article hashes to (filter fingerprint,
+	hide) pairs."""
+	storage = rawdog.get_plugin_storage("org.offog.ats.article-filter")
+	return storage.setdefault("verdicts", {})
+
+fingerprints = {}
+def filter_fingerprint(filter):
+	if filter not in fingerprints:
+		data = filter
+		if isinstance(data, unicode):
+			data = data.encode("utf-8")
+		fingerprints[filter] = hashlib.sha1(data).hexdigest()
+	return fingerprints[filter]
+
+timeouts = 0
+
+def decide(rawdog, config, article):
+	"""Run the filter for an article, and remember the verdict."""
+	fargs = rawdog.feeds[article.feed].args
+	program = get_program(article.feed, fargs)
+	if program is None:
+		return False
+	try:
+		hide = run_program(program, article)
+	except RegexTimeout:
+		global timeouts
+		timeouts += 1
+		hide = guard_hide
+		config.log("article-filter: ", article.feed, ": filtering took longer than ",
+		           guard_budget, "s; ", hide and "hiding" or "showing",
+		           " article ", article.entry_info.get("title", ""))
+	get_verdicts(rawdog)[article.hash] = (filter_fingerprint(fargs["filter"]), hide)
+	rawdog.modified()
 	return hide
 
+def match_article(rawdog, config, article):
+	fargs = rawdog.feeds[article.feed].args
+	if "filter" not in fargs:
+		return False
+	verdict = get_verdicts(rawdog).get(article.hash)
+	if verdict is not None and verdict[0] == filter_fingerprint(fargs["filter"]):
+		return verdict[1]
+	return decide(rawdog, config, article)
+
+def article_changed(rawdog, config, article, now):
+	decide(rawdog, config, article)
+	return True
+
+def article_expired(rawdog, config, article, now):
+	verdicts = get_verdicts(rawdog)
+	if article.hash in verdicts:
+		del verdicts[article.hash]
+		rawdog.modified()
+	return True
+
+show_stats = False
+
+def config_option(config, name, value):
+	if name == "filterstats":
+		global show_stats
+		show_stats = (value == "true")
+		return False
+	return True
+
+def shutdown(rawdog, config):
+	"""Print statistics for each rule, slowest first."""
+	worker.stop()
+	if timeouts != 0:
+		config.log("article-filter: ", timeouts, " articles ran out of time")
+	if not show_stats:
+		return True
+	rules = []
+	for url, (filter, program) in programs.items():
+		for rule in program:
+			rules.append((rule.time, url, rule))
+	rules.sort(reverse=True)
+	print "article-filter statistics:"
+	for t, url, rule in rules:
+		if rule.evaluations == 0:
+			rate = 0.0
+		else:
+			rate = 100.0 * rule.hits / rule.evaluations
+		print "%8.3fs %6d evaluated %5.1f%% matched  %s: %s" % (t, rule.evaluations, rate, url, rule.text)
+	return True
+
+def startup(rawdog, config):
+	"""Compile all the feeds' filters, so that errors are reported
+	straight away."""
+	read_guard_options(config)
+	for url, feed in rawdog.feeds.items():
+		program = get_program(url, feed.args)
+		if program is None:
+			continue
+		for rule in program:
+			for pattern in rule.hazards:
+				config.log("article-filter: ", url, ": regexp has nested repeats and may be slow: ", pattern)
+	return True
+
 def output_sorted_filter(rawdog, config, articles):
 	orig = len(articles)
 	config.log("article-filter: examining ", orig, " articles")
 	for i in reversed(range(len(articles))):
-		if match_article(rawdog, articles[i]):
+		if match_article(rawdog, config, articles[i]):
 			del articles[i]
 	config.log("article-filter: hid ", orig - len(articles), " articles")
 	return True
 
+rawdoglib.plugins.attach_hook("config_option", config_option)
+rawdoglib.plugins.attach_hook("startup", startup)
+rawdoglib.plugins.attach_hook("shutdown", shutdown)
+rawdoglib.plugins.attach_hook("article_added", article_changed)
+rawdoglib.plugins.attach_hook("article_updated", article_changed)
+rawdoglib.plugins.attach_hook("article_expired", article_expired)
 rawdoglib.plugins.attach_hook("output_sorted_filter", output_sorted_filter)
@@ -32,12 +32,15 @@ These configuration options are understood:
 
 - "calendardateformat" is the strftime format used for dates in calendars.
 
+If "define gzipoutput true" is set, a gzip-compressed copy of each output
+file is written alongside it with a .gz suffix.
+
 It is assumed that you're using rawdog's default article sorting mechanism.
 If you're using another plugin that orders the articles differently, this
 will not work very well.
 """
 
-import os, time, datetime, calendar
+import os, time, datetime, calendar, gzip
 import rawdoglib.plugins
 from rawdoglib.rawdog import DayWriter, write_ascii, format_time, fill_template, safe_ftime, encode_references, get_system_encoding
 from StringIO import StringIO
@@ -48,6 +51,34 @@ def safe_strftime(obj, format):
 	u = unicode(obj.strftime(format), get_system_encoding())
 	return encode_references(u)
 
+def replace_output(config, fn):
+	"""Rename the newly-written fn.new to fn. If "define gzipoutput true"
+	is set, also write a gzip-compressed copy alongside it as fn.gz (for
+	web servers' gzip_static support), unless the contents haven't
+	changed since the existing copy was made."""
+	newfn = fn + ".new"
+	gzfn = fn + ".gz"
+	compress = False
+	if config["defines"].get("gzipoutput") == "true":
+		f = open(newfn, "rb")
+		data = f.read()
+		f.close()
+		compress = True
+		if os.path.exists(fn) and os.path.exists(gzfn):
+			f = open(fn, "rb")
+			compress = (f.read() != data)
+			f.close()
+		if compress:
+			gzf = open(gzfn + ".new", "wb")
+			f = gzip.GzipFile(os.path.basename(fn), "wb", 9, gzf)
+			f.write(data)
+			f.close()
+			gzf.close()
+
+	os.rename(newfn, fn)
+	if compress:
+		os.rename(gzfn + ".new", gzfn)
+
 class DatedOutput:
 	def __init__(self):
 		self.page_date_format = "%Y-%m-%d"
@@ -225,7 +256,7 @@ class DatedOutput:
 		f = open(fn + ".new", "w")
 		write_ascii(f, s, config)
 		f.close()
-		os.rename(fn + ".new", fn)
+		replace_output(config, fn)
 
 	def set_filename(self, rawdog, config, fn):
 		"""Set the output filename. If it changes, switch to a new
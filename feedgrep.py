@@ -22,6 +22,72 @@ options are considered part of the regular expression, although trailing
 spaces are trimmed.  Regular expressions that start with the "-"
 character should start with "\-" instead.
 
+Several regular expressions can be given for a feed by adding more
+options whose names start with "grep" (for example "grep2" or
+"grep-monitors"); an article is kept if any of them match.  All of a
+feed's expressions must use the same -s and -v options.  Expressions
+with the same -i option are combined into a single alternation, so each
+piece of text is only scanned once -- except for expressions containing
+backreferences, named groups or inline flags such as "(?i)", which
+would mean something different as part of an alternation, and so are
+searched for separately.
+
+Each feed's expressions are parsed and compiled once, when rawdog
+starts.  The number of articles examined and matched for each feed, and
+the time spent matching, are logged at shutdown.
+
+Keyword watchlists:
+
+Rather than per-feed regular expressions, a global list of keywords can
+be watched for across all feeds by giving these options:
+
+    watchlist FILE
+         Read keywords from FILE, one per line.  Blank lines and lines
+         starting with "#" are ignored.
+
+    watchlistmode tag|keep
+         With "tag" (the default), articles are kept regardless, and the
+         keywords that matched are made available to the item template
+         as __watchlist__.  With "keep", only articles that match at
+         least one keyword are kept.
+
+Keywords are matched case-insensitively, against whole words in the
+title, summary and content of each article, with HTML tags removed.
+All the keywords are searched for in a single pass over each piece of
+text, so the matching time doesn't grow with the number of keywords.
+Articles ignored by a grep option aren't searched.
+
+Guarding against slow expressions:
+
+Some regular expressions, such as "(a+)+$" or "(a|aa)+$", can take an
+extremely long time to run against unlucky text.  To stop one of these
+from holding up rawdog, all the searches are done by a separate worker
+process, which is killed if the searches for an article take longer than
+the time allowed (on systems that support fork).  The article is then
+given a default verdict, and a message is logged.  When rawdog starts,
+each expression is also checked for nested repeats like "(a+)+", and a
+warning is logged for any that are found; this check can't spot every
+slow expression (for example, repeated alternatives that overlap, like
+"(a|aa)+"), but the time limit applies to them all.  These defines in
+the main config file control this, and are shared with the
+article-filter plugin:
+
+    define regexbudget SECONDS
+         The time allowed for matching each article (default 2; 0
+         means no limit).
+
+    define regexdefault show|hide
+         Whether articles that run out of time are kept or ignored
+         (default "show").
+
+    define regexhazards guard|reject
+         With "reject", expressions with nested repeats are treated
+         as configuration errors rather than being guarded.
+
+The code for this is duplicated in article-filter.py, so that each plugin
+can be used on its own; the two copies (from nested_repeat to RegexGuard)
+are identical, and changes to one should be made to the other as well.
+
 Example Configuration:
 
     feed 1h http://www.mysite.com/myfeed.rdf
@@ -30,92 +96,400 @@ Example Configuration:
     feed 1h http://www.mysite.com/myfeed2.rdf
         grep \b[Ii]nteresting\b|\bexciting\b
 
-Limitations:
-
-Only one regular expression can be specified per feed.
+    feed 1h http://www.mysite.com/myfeed3.rdf
+        grep -i dell
+        grep2 -i lenovo
 
 """
 
 import rawdoglib.rawdog
 import rawdoglib.plugins
-import re
+import cPickle, os, re, select, signal, sre_constants, sre_parse, struct
+import threading, time
 
-__version__ = "1.0"
+__version__ = "1.1"
 __author__ = "Steve Atwell <atwell@uiuc.edu>"
 __date__ = "$Date: 2005-01-22 21:07:56 -0600 (Sat, 22 Jan 2005) $"
 
-class _RECache:
+stripre = re.compile(r'<.*?>|\n')
+spacere = re.compile(r' +')
+
+def nested_repeat(items, outer=False):
+	"""Return True if a parsed regular expression contains an
+	unbounded repeat inside another repeat, such as "(a+)+"."""
+	for op, av in items:
+		if op in (sre_constants.MAX_REPEAT, sre_constants.MIN_REPEAT):
+			(lo, hi, sub) = av
+			if outer and hi == sre_constants.MAXREPEAT:
+				return True
+			if nested_repeat(sub, outer or hi > 1):
+				return True
+			continue
+		if isinstance(av, sre_parse.SubPattern):
+			av = [av]
+		elif not isinstance(av, (list, tuple)):
+			continue
+		for sub in av:
+			if isinstance(sub, list):
+				subs = sub
+			else:
+				subs = [sub]
+			for sub in subs:
+				if isinstance(sub, sre_parse.SubPattern) and nested_repeat(sub, outer):
+					return True
+	return False
+
+def is_hazardous(pattern, reflags=0):
+	"""Return True if pattern may need exponential time to match."""
+	try:
+		return nested_repeat(sre_parse.parse(pattern, reflags))
+	except (re.error, sre_constants.error):
+		return False
+
+def write_message(fd, obj):
+	data = cPickle.dumps(obj, 2)
+	data = struct.pack(">I", len(data)) + data
+	while data != "":
+		data = data[os.write(fd, data):]
+
+def read_exactly(fd, size, deadline):
+	"""Read size bytes from fd, returning None at end of file or if the
+	deadline (if it isn't None) passes first."""
+	chunks = []
+	while size > 0:
+		if deadline is not None:
+			remaining = deadline - time.time()
+			if remaining <= 0:
+				return None
+			if select.select([fd], [], [], remaining)[0] == []:
+				return None
+		chunk = os.read(fd, min(size, 65536))
+		if chunk == "":
+			return None
+		chunks.append(chunk)
+		size -= len(chunk)
+	return "".join(chunks)
+
+def read_message(fd, deadline=None):
+	header = read_exactly(fd, 4, deadline)
+	if header is None:
+		return None
+	data = read_exactly(fd, struct.unpack(">I", header)[0], deadline)
+	if data is None:
+		return None
+	return cPickle.loads(data)
+
+def search_texts(regexes, texts):
+	"""Return True if any of regexes matches any of texts."""
+	for text in texts:
+		for regex in regexes:
+			if regex.search(text) is not None:
+				return True
+	return False
+
+class RegexWorker:
+	"""A child process that runs regular expression searches, so that a
+	search that's taking too long can be stopped by killing it. It's
+	started when it's first needed, and again after it's been killed."""
+
 	def __init__(self):
-		self._cache = {}
+		self.pid = None
+		self.lock = threading.Lock()
+
+	def start(self):
+		(req_r, req_w) = os.pipe()
+		(resp_r, resp_w) = os.pipe()
+		pid = os.fork()
+		if pid == 0:
+			code = 1
+			try:
+				os.close(req_w)
+				os.close(resp_r)
+				self.serve(req_r, resp_w)
+				code = 0
+			finally:
+				os._exit(code)
+		os.close(req_r)
+		os.close(resp_w)
+		(self.pid, self.req, self.resp) = (pid, req_w, resp_r)
+
+	def serve(self, req, resp):
+		regexes = {}
+		while True:
+			jobs = read_message(req)
+			if jobs is None:
+				return
+			results = []
+			for (patterns, texts) in jobs:
+				for key in patterns:
+					if key not in regexes:
+						regexes[key] = re.compile(key[0], key[1])
+				results.append(search_texts([regexes[key] for key in patterns], texts))
+			write_message(resp, results)
 
-	def compile(self, pattern, flags=0):
+	def stop(self):
+		if self.pid is None:
+			return
+		os.close(self.req)
+		os.close(self.resp)
 		try:
-			return self._cache[(pattern, flags)]
-		except KeyError:
-			compiled = re.compile(pattern, flags)
-			self._cache[(pattern, flags)] = compiled
-			return compiled
+			os.kill(self.pid, signal.SIGKILL)
+		except OSError:
+			pass
+		os.waitpid(self.pid, 0)
+		self.pid = None
 
+	def search(self, jobs, deadline):
+		"""Run a list of (regexes, texts) searches in one go, returning a
+		list of whether each matched, or None if they didn't finish
+		before the deadline."""
+		self.lock.acquire()
+		try:
+			if self.pid is None:
+				self.start()
+			results = None
+			try:
+				write_message(self.req, [([(r.pattern, r.flags) for r in regexes], texts)
+				                         for (regexes, texts) in jobs])
+				results = read_message(self.resp, deadline)
+			except (OSError, IOError):
+				pass
+			if results is None:
+				self.stop()
+			return results
+		finally:
+			self.lock.release()
 
-cache = _RECache()
-stripre = re.compile(r'<.*?>|\n')
-spacere = re.compile(r' +')
+worker = RegexWorker()
 
-def grep(rawdog, config, article, ignore):
-	"""Handle new articles using the article_seen hook."""
+class RegexTimeout(Exception):
+	pass
 
-	global cache, stripre, spacere
+# The guard settings, from the regexbudget, regexdefault and regexhazards
+# defines.
+guard_budget = 2.0
+guard_hide = False
+guard_reject = False
 
-	ignore.value = False
-	feedargs = rawdog.feeds[article.feed].args
+def read_guard_options(config):
+	global guard_budget, guard_hide, guard_reject
+	defines = config["defines"]
+	try:
+		guard_budget = float(defines.get("regexbudget", "2"))
+	except ValueError:
+		raise rawdoglib.rawdog.ConfigError("bad regexbudget define: " + defines["regexbudget"])
+	guard_hide = (defines.get("regexdefault", "show") == "hide")
+	guard_reject = (defines.get("regexhazards", "guard") == "reject")
+
+class RegexGuard:
+	"""Runs the searches for one article within the time budget."""
+
+	def __init__(self):
+		if guard_budget > 0 and hasattr(os, "fork"):
+			self.deadline = time.time() + guard_budget
+		else:
+			self.deadline = None
+
+	def search(self, jobs):
+		"""Run a list of (regexes, texts) searches, returning a list of
+		whether any of each one's regexes matched any of its texts, and
+		raising RegexTimeout if the budget runs out. All the searches
+		are sent to the worker together."""
+		if self.deadline is None:
+			return [search_texts(regexes, texts) for (regexes, texts) in jobs]
+		if jobs == []:
+			return []
+		if self.deadline <= time.time():
+			raise RegexTimeout()
+		results = worker.search(jobs, self.deadline)
+		if results is None:
+			raise RegexTimeout()
+		return results
+
+def parse_grep(url, grepline):
+	"""Parse a grep option into (regex, flags, invert, strip)."""
+	reflags = re.U + re.S
+	invert = False
+	strip = False
+
+	grepline = grepline.strip()
+	while grepline[0] == "-":
+		try:
+			(opt, grepline) = grepline.split(None, 1)
+		except ValueError:
+			raise rawdoglib.rawdog.ConfigError("feedgrep: missing regex for feed %s" % (url,))
+		for o in opt[1:]:
+			if o == "i":
+				reflags += re.I
+			elif o == "v":
+				invert = True
+			elif o == "s":
+				strip = True
+			else:
+				raise rawdoglib.rawdog.ConfigError("feedgrep: bad option -%s for feed %s" % (o, url))
+	return (grepline, reflags, invert, strip)
+
+def has_backref(items):
+	"""Return True if a parsed regular expression contains a
+	backreference."""
+	for op, av in items:
+		if op in (sre_constants.GROUPREF, sre_constants.GROUPREF_EXISTS):
+			return True
+		if isinstance(av, sre_parse.SubPattern):
+			av = [av]
+		elif not isinstance(av, (list, tuple)):
+			continue
+		for sub in av:
+			if isinstance(sub, list):
+				subs = sub
+			else:
+				subs = [sub]
+			for sub in subs:
+				if isinstance(sub, sre_parse.SubPattern) and has_backref(sub):
+					return True
+	return False
+
+def combinable(pattern, reflags):
+	"""Return True if pattern can be combined with others into an
+	alternation without changing what it matches."""
+	try:
+		parsed = sre_parse.parse(pattern, reflags)
+	except (re.error, sre_constants.error):
+		# Compiling it on its own will report the error.
+		return False
+	return (parsed.pattern.flags == reflags
+	        and parsed.pattern.groupdict == {}
+	        and not has_backref(parsed))
+
+class Matcher:
+	"""The compiled grep expressions for a feed."""
 
-	if feedargs.has_key("grep"):
-		reflags = re.U + re.S
-		invert = False
-		strip = False
+	def __init__(self, url, greplines):
+		self.url = url
+		self.invert = None
+		self.strip = None
+		self.examined = 0
+		self.matched = 0
+		self.timeouts = 0
+		self.time = 0.0
+		self.hazards = []
 
-		# Parse options
-		grepline = feedargs["grep"].strip()
-		while grepline[0] == "-":
+		patterns = {}
+		for grepline in greplines:
+			(pattern, reflags, invert, strip) = parse_grep(url, grepline)
+			if self.invert is None:
+				self.invert = invert
+				self.strip = strip
+			elif (invert, strip) != (self.invert, self.strip):
+				raise rawdoglib.rawdog.ConfigError("feedgrep: grep options for feed %s must all use the same -s and -v" % (url,))
+			patterns.setdefault(reflags, []).append(pattern)
+
+		groups = []
+		for reflags, pl in patterns.items():
+			joined = [p for p in pl if combinable(p, reflags)]
+			if joined != []:
+				groups.append((reflags, joined))
+			for p in pl:
+				if p not in joined:
+					groups.append((reflags, [p]))
+
+		self.regexes = []
+		for reflags, pl in groups:
+			if len(pl) == 1:
+				pattern = pl[0]
+			else:
+				pattern = "|".join(["(?:%s)" % p for p in pl])
 			try:
-				(opt, grepline) = grepline.split(None, 1)
-			except ValueError:
-				raise rawdoglib.rawdog.ConfigError("feedgrep: missing regex for feed %s" % (article.feed,))
-			for o in opt[1:]:
-				if o == "i":
-					reflags += re.I
-				elif o == "v":
-					invert = True
-				elif o == "s":
-					strip = True
-				else:
-					raise rawdoglig.rawdog.ConfigError("feedgrep: bad option -%s for feed %s" % (o, article.feed))
-			
-		ignore.value = True
-		grepre = cache.compile(grepline, reflags)
+				regex = re.compile(pattern, reflags)
+			except re.error, e:
+				raise rawdoglib.rawdog.ConfigError("feedgrep: bad regex for feed %s: %s" % (url, e))
+			hazards = [p for p in pl if is_hazardous(p, reflags)]
+			if hazards != [] and guard_reject:
+				raise rawdoglib.rawdog.ConfigError("feedgrep: regex for feed %s has nested repeats: %s" % (url, hazards[0]))
+			self.hazards += hazards
+			self.regexes.append(regex)
+
+	def search(self, text):
+		"""Return True if any of the expressions match any of the
+		strings in text."""
+		return RegexGuard().search([(self.regexes, text)])[0]
+
+	def keep(self, config, entry_info):
+		"""Return True if an article should be kept."""
+		start = time.time()
 
 		# Copy the text we will search so that we can modify
 		# it if the strip option is set
 		text = []
 		for piece in ["title", "summary"]:
-			if (article.entry_info.has_key(piece)):
-				text.append(article.entry_info[piece])
+			if (entry_info.has_key(piece)):
+				text.append(entry_info[piece])
 
 		# Strip text.  First replace HTML tags and newlines with
 		# spaces, and then condense multiples spaces into a
 		# single space.
-		if strip:
+		if self.strip:
 			for i in range(len(text)):
 				text[i] = stripre.sub(' ', text[i])
 				text[i] = spacere.sub(' ', text[i])
-			
-		for piece in text:
-			if (grepre.search(piece)):
-				ignore.value = False
-				break
 
-		if invert:
-			ignore.value = not ignore.value
+		try:
+			keep = self.search(text)
+			if self.invert:
+				keep = not keep
+		except RegexTimeout:
+			keep = not guard_hide
+			self.timeouts += 1
+			config.log("feedgrep: ", self.url, ": matching took longer than ",
+			           guard_budget, "s; ", keep and "keeping" or "ignoring",
+			           " article ", entry_info.get("title", ""))
+
+		self.examined += 1
+		if keep:
+			self.matched += 1
+		self.time += time.time() - start
+		return keep
+
+def grep_args(feedargs):
+	"""Return the sorted list of grep options for a feed."""
+	names = [name for name in feedargs.keys() if name.startswith("grep")]
+	names.sort()
+	return [feedargs[name] for name in names]
+
+# Maps feed URLs to (grep options, Matcher).
+matchers = {}
+
+def get_matcher(url, feedargs):
+	"""Return the Matcher for a feed, or None if it doesn't use grep.
+	The Matcher is rebuilt if the feed's options have changed."""
+	greplines = grep_args(feedargs)
+	if greplines == []:
+		return None
+	cached = matchers.get(url)
+	if cached is None or cached[0] != greplines:
+		cached = (greplines, Matcher(url, greplines))
+		matchers[url] = cached
+	return cached[1]
+
+def startup(rawdog, config):
+	"""Compile the expressions for all feeds."""
+	read_guard_options(config)
+	for url, feed in rawdog.feeds.items():
+		matcher = get_matcher(url, feed.args)
+		if matcher is None:
+			continue
+		for pattern in matcher.hazards:
+			config.log("feedgrep: ", url, ": regex has nested repeats and may be slow: ", pattern)
+	return True
+
+def grep(rawdog, config, article, ignore):
+	"""Handle new articles using the article_seen hook."""
+
+	ignore.value = False
+	matcher = get_matcher(article.feed, rawdog.feeds[article.feed].args)
+
+	if matcher is not None:
+		ignore.value = not matcher.keep(config, article.entry_info)
 
 		# if we decided to ignore this, don't bother processing
 		# it further
@@ -123,4 +497,170 @@ def grep(rawdog, config, article, ignore):
 
 	return True
 
+def shutdown(rawdog, config):
+	"""Report the matching statistics for each feed."""
+	worker.stop()
+	for url, (greplines, matcher) in sorted(matchers.items()):
+		if matcher.examined == 0:
+			continue
+		config.log("feedgrep: ", url, ": kept ", matcher.matched,
+		           " of ", matcher.examined, " articles in ",
+		           "%.3f" % matcher.time, "s")
+		if matcher.timeouts != 0:
+			config.log("feedgrep: ", url, ": ", matcher.timeouts,
+			           " articles ran out of time")
+	return True
+
+class AhoCorasick:
+	"""An Aho-Corasick automaton that finds all of a set of keywords in
+	a string in a single pass."""
+
+	def __init__(self, keywords):
+		# For each state: transitions, failure link, and the keywords
+		# that end at it.
+		self.goto = [{}]
+		self.fail = [0]
+		self.out = [[]]
+
+		for keyword in keywords:
+			state = 0
+			for c in keyword:
+				next = self.goto[state].get(c)
+				if next is None:
+					next = len(self.goto)
+					self.goto.append({})
+					self.fail.append(0)
+					self.out.append([])
+					self.goto[state][c] = next
+				state = next
+			self.out[state].append(keyword)
+
+		# Compute the failure links breadth-first.
+		queue = self.goto[0].values()
+		while queue != []:
+			state = queue.pop(0)
+			for c, next in self.goto[state].items():
+				queue.append(next)
+				f = self.fail[state]
+				while f != 0 and c not in self.goto[f]:
+					f = self.fail[f]
+				f = self.goto[f].get(c, 0)
+				self.fail[next] = f
+				self.out[next] = self.out[next] + self.out[f]
+
+	def search(self, text):
+		"""Return the set of keywords that occur as whole words in
+		text."""
+		found = set()
+		goto, fail, out = self.goto, self.fail, self.out
+		state = 0
+		end = len(text)
+		for i in xrange(end):
+			c = text[i]
+			while state != 0 and c not in goto[state]:
+				state = fail[state]
+			state = goto[state].get(c, 0)
+			for keyword in out[state]:
+				start = i - len(keyword) + 1
+				if start > 0 and text[start - 1].isalnum():
+					continue
+				if i + 1 < end and text[i + 1].isalnum():
+					continue
+				found.add(keyword)
+		return found
+
+class Watchlist:
+	"""A global list of keywords to watch for in all articles."""
+
+	def __init__(self):
+		self.filename = None
+		self.mode = "tag"
+		self.automaton = None
+		self.names = {}
+		self.examined = 0
+		self.matched = 0
+		self.time = 0.0
+
+	def config_option(self, config, name, value):
+		if name == "watchlist":
+			self.filename = value
+			return False
+		elif name == "watchlistmode":
+			if value not in ("tag", "keep"):
+				raise rawdoglib.rawdog.ConfigError("feedgrep: bad watchlistmode %s" % (value,))
+			self.mode = value
+			return False
+		return True
+
+	def startup(self, rawdog, config):
+		"""Load the keyword file and build the automaton."""
+		if self.filename is None:
+			return True
+		try:
+			f = open(self.filename)
+		except IOError, e:
+			raise rawdoglib.rawdog.ConfigError("feedgrep: can't read watchlist %s: %s" % (self.filename, e))
+		for l in f.readlines():
+			l = l.strip()
+			if l == "" or l.startswith("#"):
+				continue
+			l = l.decode("utf-8")
+			self.names[l.lower()] = l
+		f.close()
+		self.automaton = AhoCorasick(self.names.keys())
+		config.log("feedgrep: watching for ", len(self.names), " keywords")
+		return True
+
+	def article_seen(self, rawdog, config, article, ignore):
+		if self.automaton is None:
+			return True
+		start = time.time()
+
+		entry_info = article.entry_info
+		text = []
+		for piece in ["title", "summary"]:
+			if entry_info.has_key(piece):
+				text.append(entry_info[piece])
+		for content in entry_info.get("content", []):
+			text.append(content["value"])
+
+		found = set()
+		for piece in text:
+			piece = spacere.sub(' ', stripre.sub(' ', piece))
+			found |= self.automaton.search(piece.lower())
+
+		matches = [self.names[k] for k in sorted(found)]
+		entry_info["watchlist_matches"] = matches
+
+		self.examined += 1
+		if matches != []:
+			self.matched += 1
+		self.time += time.time() - start
+
+		if self.mode == "keep" and matches == []:
+			ignore.value = True
+			return False
+		return True
+
+	def output_item_bits(self, rawdog, config, feed, article, itembits):
+		matches = article.entry_info.get("watchlist_matches", [])
+		itembits["watchlist"] = rawdoglib.rawdog.string_to_html(", ".join(matches), config)
+		return True
+
+	def shutdown(self, rawdog, config):
+		if self.examined != 0:
+			config.log("feedgrep: watchlist matched ", self.matched,
+			           " of ", self.examined, " articles in ",
+			           "%.3f" % self.time, "s")
+		return True
+
+watchlist = Watchlist()
+
+rawdoglib.plugins.attach_hook("config_option", watchlist.config_option)
+rawdoglib.plugins.attach_hook("startup", startup)
+rawdoglib.plugins.attach_hook("startup", watchlist.startup)
 rawdoglib.plugins.attach_hook("article_seen", grep)
+rawdoglib.plugins.attach_hook("article_seen", watchlist.article_seen)
+rawdoglib.plugins.attach_hook("output_item_bits", watchlist.output_item_bits)
+rawdoglib.plugins.attach_hook("shutdown", shutdown)
+rawdoglib.plugins.attach_hook("shutdown", watchlist.shutdown)
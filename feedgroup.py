@@ -8,13 +8,44 @@ Writes out articles grouped by the define_group setting on feeds,
 with an 'Other' group for articles from feeds without the setting.
 
 Also generates a header with links to each group with articles.
+
+If "define gzipoutput true" is set, a gzip-compressed copy of the output
+file is written alongside it with a .gz suffix.
 """
 
-import os
+import os, sys, gzip
 import rawdoglib.plugins
 from rawdoglib.rawdog import DayWriter, write_ascii, fill_template
 from StringIO import StringIO
 
+def replace_output(config, fn):
+	"""Rename the newly-written fn.new to fn. If "define gzipoutput true"
+	is set, also write a gzip-compressed copy alongside it as fn.gz (for
+	web servers' gzip_static support), unless the contents haven't
+	changed since the existing copy was made."""
+	newfn = fn + ".new"
+	gzfn = fn + ".gz"
+	compress = False
+	if config["defines"].get("gzipoutput") == "true":
+		f = open(newfn, "rb")
+		data = f.read()
+		f.close()
+		compress = True
+		if os.path.exists(fn) and os.path.exists(gzfn):
+			f = open(fn, "rb")
+			compress = (f.read() != data)
+			f.close()
+		if compress:
+			gzf = open(gzfn + ".new", "wb")
+			f = gzip.GzipFile(os.path.basename(fn), "wb", 9, gzf)
+			f.write(data)
+			f.close()
+			gzf.close()
+
+	os.rename(newfn, fn)
+	if compress:
+		os.rename(gzfn + ".new", gzfn)
+
 def output_write_files(rawdog, config, articles, article_dates):
 	f_hdr = StringIO()
 	rawdoglib.plugins.call_hook("output_items_begin", rawdog, config, f_hdr)
@@ -83,7 +114,7 @@ def output_write_files(rawdog, config, articles, article_dates):
 		f = open(outputfile + ".new", "w")
 		write_ascii(f, s, config)
 		f.close()
-		os.rename(outputfile + ".new", outputfile)
+		replace_output(config, outputfile)
 	return False
 
 rawdoglib.plugins.attach_hook("output_write_files", output_write_files)
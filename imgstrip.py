@@ -44,6 +44,62 @@ Configuration options:
   imgstrip none
      img tags are simply removed from the article
 
+  imgstrip cache
+     each image is downloaded once and stored in a local directory,
+     named by a hash of its contents so that identical images from
+     different URLs are only stored once, and the img tag is changed to
+     point at the local copy.  Only PNG, GIF, JPEG and WebP images are
+     stored, so that a feed can't put a script (in an SVG or HTML file)
+     on the page's own site.  Images that are larger than
+     imgstripmaxsize, that are of another type, or that can't be
+     downloaded, are replaced with links as in "imgstrip link"
+
+  imgstrip lazy
+     img tags are kept, but given loading="lazy" and decoding="async"
+     attributes so that the browser only fetches them as they're
+     scrolled into view, and width and height attributes (if they're
+     not already present) so that the page doesn't reflow as they
+     load.  The dimensions are found by fetching the start of each
+     image once, and remembered in imgstripsizes
+
+  imgstripsizes FILE
+     the file to remember image dimensions in (default
+     "imgstrip-sizes")
+
+  imgstripdir DIR
+     the directory to store cached images in (default "imgcache")
+
+  imgstripurl URL
+     the URL that imgstripdir is served as (default "imgcache", relative
+     to the output page)
+
+  imgstripmaxsize N
+     the largest image, in bytes, that will be cached (default 524288)
+
+  imgstripcache N
+     remember the results for the last N bodies (default 1000), so
+     that bodies seen again on the next fetch of a feed don't need to be
+     parsed again; 0 disables the cache
+
+  imgstrippersist true
+     keep the cache in rawdog's state file between runs
+
+The mode can be overridden for a particular feed by giving it an
+"imgstrip" argument:
+
+    feed 1h http://www.flickr.com/services/feeds/photos_public.gne
+        imgstrip cache
+
+Feeds are matched by the base URL that feedparser gives their articles'
+HTML, which is normally the feed's URL.
+
+Each thread gets its own parser, so this is safe to use with
+"numthreads" greater than 1.
+
+Bodies that contain no img tag are returned untouched without being
+parsed.  Otherwise, only the a and img tags are tokenized and rewritten;
+all other text is copied through unchanged.
+
 The generated link can be styled to be less obtrusive:
 
     .imgbutton {
@@ -75,13 +131,14 @@ CHANGES
  * initial release
 
 TODO
-  - make a per-feed setting, for feeds those images you want to see (flickr?)
   - something more general for stripping obnoxious tags: font, style,
     script/javascript (maybe tidy already does part of this?)
 """
 import rawdoglib.plugins
 from sgmllib import SGMLParser
 import htmlentitydefs
+import re, hashlib, threading, os, urllib2, urlparse, httplib, struct, time
+from collections import OrderedDict
 
 class BaseHTMLProcessor(SGMLParser):
     """Base class for creating HTML processing modules
@@ -173,13 +230,17 @@ class BaseHTMLProcessor(SGMLParser):
 
 
 class StripParser(BaseHTMLProcessor):
-    "Replace img tags with links or remove them."
+    "Replace img tags with links or local copies, or remove them."
     def __init__(self, strip="link", verbose=0):
         self.strip = strip
+        self.baseurl = ""
         BaseHTMLProcessor.__init__(self, verbose)
     def reset(self):
         self.a = False
         self.img = False
+        # Set if an image couldn't be downloaded, so the output shouldn't
+        # be cached.
+        self.failed = False
         BaseHTMLProcessor.reset(self)
     def start_a(self, attrs):
         self.a = True
@@ -192,15 +253,310 @@ class StripParser(BaseHTMLProcessor):
     def do_img(self, attrs):
         if self.strip == 'none':
             return
+        src = [v for k, v in attrs if k=='src']
+        if self.strip == 'lazy':
+            names = [k for k, v in attrs]
+            attrs = [(k, v) for k, v in attrs
+                     if k not in ('loading', 'decoding')]
+            attrs += [('loading', 'lazy'), ('decoding', 'async')]
+            if src != [] and 'width' not in names and 'height' not in names:
+                size = sizes.size(urlparse.urljoin(self.baseurl, src[0]))
+                if size is False:
+                    self.failed = True
+                elif size is not None:
+                    attrs += [('width', str(size[0])),
+                              ('height', str(size[1]))]
+            self.unknown_starttag("img", attrs)
+            return
+        if self.strip == 'cache' and src != []:
+            local = images.local_url(urlparse.urljoin(self.baseurl, src[0]))
+            if local is False:
+                self.failed = True
+            elif local is not None:
+                attrs = [(k, v) for k, v in attrs if k != 'src']
+                self.unknown_starttag("img", [('src', local)] + attrs)
+                return
         self.img = True
         if self.a:
             # we are wrapped in an <a> tag, so we close it
             self.pieces.append("a</a>")
-        src = [v for k, v in attrs if k=='src'][0]
+        if src == []:
+            return
+        src = src[0]
         self.pieces.append('<a class="imgbutton" href="%s">IMG</a>' % src)
 
 
-parser = StripParser(verbose=1)
+img_re = re.compile(r'<img\b', re.I)
+tag_re = re.compile(r'<!--.*?-->|<(/?)(a|img)\b([^>]*)>', re.I | re.S)
+attr_re = re.compile(r'\s*([a-zA-Z_][-:.a-zA-Z_0-9]*)'
+                     r'(\s*=\s*(\'[^\']*\'|"[^"]*"|[^\s>]*))?')
+
+def parse_attrs(s):
+    """Parse the attributes of a tag into a list of (name, value)
+    pairs, as SGMLParser would."""
+    attrs = []
+    for m in attr_re.finditer(s):
+        name, rest, value = m.groups()
+        if not rest:
+            value = name
+        elif value[:1] == value[-1:] and value[:1] in ('"', "'"):
+            value = value[1:-1]
+        attrs.append((name.lower(), value))
+    return attrs
+
+class FastStripParser(StripParser):
+    """StripParser that only tokenizes a and img tags, and copies all
+    other text through unchanged."""
+    def feed(self, data):
+        pos = 0
+        for m in tag_re.finditer(data):
+            self.pieces.append(data[pos:m.start()])
+            pos = m.end()
+            if m.group(2) is None:
+                # A comment; tags inside it are left alone.
+                self.pieces.append(m.group(0))
+                continue
+            tag = m.group(2).lower()
+            if m.group(1):
+                if tag == 'a':
+                    self.end_a()
+            elif tag == 'a':
+                self.start_a(parse_attrs(m.group(3)))
+            else:
+                self.do_img(parse_attrs(m.group(3)))
+        self.pieces.append(data[pos:])
+    def close(self):
+        pass
+
+
+def fetchable(url):
+    """Return True if url is one that images may be fetched from; feeds
+    mustn't be able to make rawdog read local files."""
+    return urlparse.urlparse(url)[0].lower() in ('http', 'https')
+
+def image_type(data):
+    """Return the file extension for a PNG, GIF, JPEG or WebP image from
+    the start of its data, or None if it isn't one of those."""
+    if data[:8] == '\x89PNG\r\n\x1a\n':
+        return '.png'
+    if data[:6] in ('GIF87a', 'GIF89a'):
+        return '.gif'
+    if data[:3] == '\xff\xd8\xff':
+        return '.jpg'
+    if data[:4] == 'RIFF' and data[8:12] == 'WEBP':
+        return '.webp'
+    return None
+
+class ImageCache:
+    """Downloads images and stores them on disk, named by the hash of
+    their contents."""
+    extensions = ('.png', '.gif', '.jpg', '.webp')
+
+    def __init__(self):
+        self.dir = "imgcache"
+        self.url = None
+        self.max_size = 512 * 1024
+        self.timeout = 30
+        # Maps image URLs to stored filenames, or None for images that
+        # are too large to store.
+        self.files = {}
+        self.lock = threading.Lock()
+
+    def local_url(self, src):
+        """Return the local URL for the image at src, downloading it if
+        it hasn't been seen before. Return None if it can't be stored, or
+        False if it couldn't be downloaded this time."""
+        self.lock.acquire()
+        try:
+            known = self.files.has_key(src)
+            fn = self.files.get(src)
+        finally:
+            self.lock.release()
+        if not known:
+            fn = self.fetch(src)
+            if fn is False:
+                return False
+            self.lock.acquire()
+            self.files[src] = fn
+            self.lock.release()
+        if fn is None:
+            return None
+        if self.url is None:
+            return self.dir + "/" + fn
+        return self.url + "/" + fn
+
+    def fetch(self, src):
+        """Download an image and store it. Return its filename, None if
+        it's too large or isn't a raster image, or False if it couldn't be
+        downloaded."""
+        if not fetchable(src):
+            return False
+        try:
+            f = urllib2.urlopen(src, timeout=self.timeout)
+            data = f.read(self.max_size + 1)
+            f.close()
+        except (IOError, ValueError, httplib.HTTPException):
+            return False
+        if len(data) > self.max_size:
+            return None
+
+        # The file's served from the page's own site, so don't trust the
+        # URL's extension or the server's content type.
+        ext = image_type(data)
+        if ext is None:
+            return None
+        fn = hashlib.sha1(data).hexdigest() + ext
+        path = os.path.join(self.dir, fn)
+        if not os.path.exists(path):
+            if not os.path.isdir(self.dir):
+                try:
+                    os.makedirs(self.dir)
+                except OSError:
+                    # Another thread got there first.
+                    pass
+            tmp = "%s.new-%d" % (path, threading.current_thread().ident)
+            f = open(tmp, "wb")
+            f.write(data)
+            f.close()
+            os.rename(tmp, path)
+        return fn
+
+images = ImageCache()
+
+def image_size(data):
+    """Return the (width, height) of a PNG, GIF or JPEG image from the
+    start of its data, or None if it can't be determined."""
+    if data[:8] == '\x89PNG\r\n\x1a\n' and len(data) >= 24:
+        return struct.unpack('>II', data[16:24])
+    if data[:6] in ('GIF87a', 'GIF89a') and len(data) >= 10:
+        return struct.unpack('<HH', data[6:10])
+    if data[:2] == '\xff\xd8':
+        i = 2
+        while i + 9 <= len(data) and data[i] == '\xff':
+            marker = ord(data[i + 1])
+            if 0xc0 <= marker <= 0xcf and marker not in (0xc4, 0xc8, 0xcc):
+                (h, w) = struct.unpack('>HH', data[i + 5:i + 9])
+                return (w, h)
+            i += 2 + struct.unpack('>H', data[i + 2:i + 4])[0]
+    return None
+
+class ImageSizes:
+    """Finds the dimensions of images, remembering them in a file so
+    that each image only needs to be probed once."""
+    probe_bytes = 64 * 1024
+
+    def __init__(self):
+        self.filename = "imgstrip-sizes"
+        self.timeout = 30
+        # Maps image URLs to (width, height), or None if unknown.
+        self.sizes = None
+        self.changed = False
+        self.lock = threading.Lock()
+
+    def load(self):
+        self.sizes = {}
+        try:
+            f = open(self.filename)
+        except IOError:
+            return
+        for l in f.readlines():
+            (w, h, url) = l.rstrip("\n").split(" ", 2)
+            if w == "-":
+                self.sizes[url] = None
+            else:
+                self.sizes[url] = (int(w), int(h))
+        f.close()
+
+    def save(self):
+        if not self.changed:
+            return
+        f = open(self.filename + ".new", "w")
+        for url, size in sorted(self.sizes.items()):
+            if size is None:
+                f.write("- - %s\n" % url)
+            else:
+                f.write("%d %d %s\n" % (size[0], size[1], url))
+        f.close()
+        os.rename(self.filename + ".new", self.filename)
+        self.changed = False
+
+    def size(self, src):
+        """Return the (width, height) of the image at src, None if it
+        can't be determined, or False if the image couldn't be fetched this
+        time."""
+        self.lock.acquire()
+        try:
+            if self.sizes is None:
+                self.load()
+            if self.sizes.has_key(src):
+                return self.sizes[src]
+        finally:
+            self.lock.release()
+        if not fetchable(src):
+            return None
+
+        try:
+            f = urllib2.urlopen(src, timeout=self.timeout)
+            data = f.read(self.probe_bytes)
+            f.close()
+        except (IOError, ValueError, httplib.HTTPException):
+            # Might be temporary, so don't remember it.
+            return False
+        size = image_size(data)
+
+        self.lock.acquire()
+        self.sizes[src] = size
+        self.changed = True
+        self.lock.release()
+        return size
+
+sizes = ImageSizes()
+
+class ParserPool(threading.local):
+    "Hands each thread its own parser for each strip mode."
+    strip = "link"
+    def get(self, strip):
+        parsers = self.__dict__.setdefault("parsers", {})
+        if not parsers.has_key(strip):
+            parsers[strip] = FastStripParser(strip, verbose=1)
+        return parsers[strip]
+
+parsers = ParserPool()
+
+class LRUCache:
+    "A thread-safe dict-like cache that holds at most size entries."
+    def __init__(self, size):
+        self.size = size
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+    def get(self, key):
+        self.lock.acquire()
+        try:
+            try:
+                value = self.entries.pop(key)
+            except KeyError:
+                self.misses += 1
+                return None
+            self.entries[key] = value
+            self.hits += 1
+            return value
+        finally:
+            self.lock.release()
+    def put(self, key, value):
+        if self.size <= 0:
+            return
+        self.lock.acquire()
+        try:
+            self.entries.pop(key, None)
+            self.entries[key] = value
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+        finally:
+            self.lock.release()
+
+
 class ImgStripPlugin:
     """
     Strip img tags from articles.
@@ -208,15 +564,74 @@ class ImgStripPlugin:
     The image is replaced by default with a link to the image, but can
     also be only removed with the "imgstrip none" option.
     """
+    storage_name = "org.acm.vbucoci.imgstrip"
+
+    modes = ('none', 'link', 'cache', 'lazy')
+
+    def __init__(self):
+        self.cache = LRUCache(1000)
+        self.persist = False
+        self.feed_modes = {}
+
     def imgstrip(self, config, html, baseurl, inline):
         """
         Strip <img> tags from the feed HTML.
         """
         #html.value = self.img.sub(self.repl, html.value)
-        parser.reset()
-        parser.feed(html.value)
-        parser.close()
-        html.value = parser.output()
+        if img_re.search(html.value) is None:
+            return
+        body = html.value
+        if isinstance(body, unicode):
+            body = body.encode("utf-8")
+        parser = parsers.get(self.feed_modes.get(baseurl, ParserPool.strip))
+        key = (hashlib.sha1(body).hexdigest(), parser.strip, baseurl)
+        value = self.cache.get(key)
+        if value is None:
+            parser.reset()
+            parser.baseurl = baseurl or ""
+            parser.feed(html.value)
+            parser.close()
+            value = parser.output()
+            if not parser.failed:
+                self.cache.put(key, value)
+        html.value = value
+
+    def startup(self, rawdog, config):
+        for url, feed in rawdog.feeds.items():
+            mode = feed.args.get("imgstrip")
+            if mode is None:
+                continue
+            if mode not in self.modes:
+                raise ValueError, \
+                      "imgstrip error: feed %s has invalid value '%s'" \
+                      % (url, mode)
+            self.feed_modes[url] = mode
+
+        storage = rawdog.get_plugin_storage(self.storage_name)
+        for src, fn in storage.get("images", {}).items():
+            # Images stored before their contents were checked are
+            # fetched again.
+            if fn is None or os.path.splitext(fn)[1] in images.extensions:
+                images.files[src] = fn
+        if self.persist:
+            for key, value in storage.get("cache", []):
+                self.cache.put(key, value)
+        return True
+
+    def shutdown(self, rawdog, config):
+        config.log("imgstrip: cache hits ", self.cache.hits,
+                   ", misses ", self.cache.misses)
+        sizes.save()
+        storage = rawdog.get_plugin_storage(self.storage_name)
+        if images.files != storage.get("images", {}):
+            storage["images"] = images.files
+            rawdog.modified()
+        if self.persist:
+            self.cache.lock.acquire()
+            storage["cache"] = self.cache.entries.items()
+            self.cache.lock.release()
+            rawdog.modified()
+        return True
 
     def config_option(self, config, name, value):
         """
@@ -226,19 +641,169 @@ class ImgStripPlugin:
         value - 'none': simply remove the img tag
                 'link': replace the image with a link to image's source.
                         This is the default.
+                'cache': point the image at a local copy.
+                'lazy': keep the image, but have it loaded lazily.
                 anything else: raise ValueError
         """
-        global parser
         if name == 'imgstrip':
-            if value in ('none', 'link'):
-                parser = StripParser(value)
+            if value in self.modes:
+                ParserPool.strip = value
                 return False
             else:
             	raise ValueError, \
                       "imgstrip error: option '%s' has invalid value '%s'" \
                       % (name, value)
+        elif name == 'imgstripcache':
+            self.cache = LRUCache(int(value))
+            return False
+        elif name == 'imgstrippersist':
+            self.persist = (value == 'true')
+            return False
+        elif name == 'imgstripsizes':
+            sizes.filename = value
+            return False
+        elif name == 'imgstripdir':
+            images.dir = value
+            return False
+        elif name == 'imgstripurl':
+            images.url = value
+            return False
+        elif name == 'imgstripmaxsize':
+            images.max_size = int(value)
+            return False
         return True
 
 istrip = ImgStripPlugin()
 rawdoglib.plugins.attach_hook("clean_html", istrip.imgstrip)
 rawdoglib.plugins.attach_hook('config_option', istrip.config_option)
+rawdoglib.plugins.attach_hook('startup', istrip.startup)
+rawdoglib.plugins.attach_hook('shutdown', istrip.shutdown)
+
+def slashdot_body(images=True):
+    """Return an article body the size and shape of a Slashdot story, with
+    sharing buttons and a web bug if images is True."""
+    story = ('<p>Some story text with <a href="http://example.org/x?a=1">'
+             'a link</a>, an &eacute; entity, a &#8212; reference and '
+             '<i>emphasis</i>.</p><!-- a comment -->\n') * 16
+    buttons = ''.join(['<a title="Share on %s" href="http://example.org/share?s=%s">'
+                       '<img src="http://example.org/sd/%s.png"></a> '
+                       % (name, name, name)
+                       for name in ('twitter', 'facebook', 'gplus', 'email')])
+    tail = ('<p><a href="http://example.org/story/1234">Read more of this story</a>'
+            ' at Slashdot.</p>\n')
+    if not images:
+        return story + tail
+    return (story + '<div class="share">' + buttons + '</div>' + tail
+            + '<!-- <img src="hidden"> -->'
+            + '<img src="http://example.org/~r/Slashdot/~4/AbCdEf" height="1"'
+            ' width="1" alt="">')
+
+def benchmark(count):
+    """Strip count copies of a Slashdot-sized body with the sgmllib parser
+    and with the fast tokenizer, printing how long each took, and check
+    that they produced the same output. (The sample body has no entity
+    references in attribute values, which sgmllib would unescape and the
+    fast tokenizer leaves alone.)"""
+    ok = True
+    for label, body in (("with images", slashdot_body(True)),
+                        ("no images", slashdot_body(False))):
+        outputs = []
+        for name, parser in (("sgmllib", StripParser("link", verbose=1)),
+                             ("fast", FastStripParser("link", verbose=1))):
+            start = time.time()
+            for i in range(count):
+                if name == "fast" and img_re.search(body) is None:
+                    output = body
+                else:
+                    parser.reset()
+                    parser.feed(body)
+                    parser.close()
+                    output = parser.output()
+            print "%-11s %-8s %.3fs" % (label, name, time.time() - start)
+            outputs.append(output)
+        if outputs[0] != outputs[1]:
+            print "%-11s outputs differ" % label
+            ok = False
+    print "body is %d bytes" % len(slashdot_body())
+    return ok
+
+class StressHTML:
+    "Stands in for the HTML object that the clean_html hook is given."
+    def __init__(self, value):
+        self.value = value
+
+def stress(threads, rounds=4):
+    """Strip a set of bodies through the clean_html hook from several
+    threads at once, with and without the result cache, and return the
+    number of results that differed from a serial run."""
+    import sys, random
+    cases = []
+    for i in range(48):
+        body = slashdot_body(i % 4 != 0).replace("1234", str(i))
+        body = body.replace("AbCdEf", "bug%d" % i)
+        cases.append((body, ("http://example.org/link",
+                             "http://example.org/none")[i % 3 == 0]))
+
+    def strip(body, baseurl):
+        html = StressHTML(body)
+        istrip.imgstrip(None, html, baseurl, False)
+        return html.value
+
+    saved = (istrip.cache, istrip.feed_modes, sys.getcheckinterval())
+    istrip.feed_modes = {"http://example.org/none": "none"}
+    # Switch threads as often as possible, so they interleave in the
+    # middle of parsing.
+    sys.setcheckinterval(1)
+    errors = []
+    try:
+        for cache_size in (0, 16):
+            istrip.cache = LRUCache(0)
+            expected = [strip(body, baseurl) for body, baseurl in cases]
+            istrip.cache = LRUCache(cache_size)
+
+            def worker(n):
+                order = range(len(cases))
+                random.Random(n).shuffle(order)
+                for r in range(rounds):
+                    for i in order:
+                        if strip(*cases[i]) != expected[i]:
+                            errors.append(i)
+
+            workers = [threading.Thread(target=worker, args=(n,))
+                       for n in range(threads)]
+            for t in workers:
+                t.start()
+            for t in workers:
+                t.join()
+    finally:
+        (istrip.cache, istrip.feed_modes) = saved[:2]
+        sys.setcheckinterval(saved[2])
+    return len(errors)
+
+if __name__ == "__main__":
+    # Usage: python imgstrip.py benchmark [iterations]
+    #        python imgstrip.py stress [threads]
+    import sys
+    if len(sys.argv) not in (2, 3) or sys.argv[1] not in ("benchmark",
+                                                          "stress"):
+        print >>sys.stderr, "Usage: imgstrip.py benchmark [iterations]"
+        print >>sys.stderr, "       imgstrip.py stress [threads]"
+        sys.exit(1)
+    if sys.argv[1] == "stress":
+        if len(sys.argv) == 3:
+            threads = int(sys.argv[2])
+        else:
+            threads = 16
+        errors = stress(threads)
+        if errors != 0:
+            print "%d threads: %d outputs differ from a serial run" \
+                  % (threads, errors)
+            sys.exit(1)
+        print "%d threads: outputs match a serial run" % threads
+        sys.exit(0)
+    if len(sys.argv) == 3:
+        count = int(sys.argv[2])
+    else:
+        count = 2000
+    if not benchmark(count):
+        sys.exit(1)
@@ -10,23 +10,144 @@ with "articlesperpage" entries in each one.
 Generate a __paged_output_pages__ bit in the main template that lists the files
 and the date of the latest entry in each, and a __paged_output_head__ bit that
 can be included in <head> to add rel="next"/rel="prev" navigation links.
+
+If "define gzipoutput true" is set, a gzip-compressed copy of each page is
+written alongside it with a .gz suffix.
+
+Normally the first file (named by "outputfile") holds the newest articles,
+and the others are numbered from there, so every new article moves older
+articles onto different pages. With "pagenumbering stable", pages are
+numbered from the oldest instead: new articles are added to the first file
+until it holds "articlesperpage" articles, after which it's written out as
+the next numbered page and a new one is started. Each article stays on the
+page it was first put on, so a full page's articles never change (unless
+they expire), and only the first file needs writing when articles arrive. In
+this mode, the __paged_output_pages__ list shows the date of the oldest entry
+in each page, and only the first file lists every page; the numbered pages
+just list the pages either side of them, so filling up the first file only
+changes it and the page before it.
+
+A fingerprint of each page -- a digest of its articles' contents, the
+templates' modification times, the gzipoutput setting and its navigation
+bits -- is kept in rawdog's state, and pages whose fingerprint hasn't changed
+(and whose .gz copy exists, if one's wanted) aren't written again. The other main template bits
+(such as the feed list) on those pages are left as they were when the page
+was last written; the first page is always written, so it's always current.
 """
 
-import os
+import os, gzip, hashlib
 import rawdoglib.plugins
-from rawdoglib.rawdog import DayWriter, write_ascii, format_time, fill_template
+from rawdoglib.rawdog import DayWriter, write_ascii, format_time, fill_template, ConfigError
 from StringIO import StringIO
 
 articles_per_page = 100
+page_numbering = "newest"
+
+def replace_output(config, fn):
+	"""Rename the newly-written fn.new to fn. If "define gzipoutput true"
+	is set, also write a gzip-compressed copy alongside it as fn.gz (for
+	web servers' gzip_static support), unless the contents haven't
+	changed since the existing copy was made."""
+	newfn = fn + ".new"
+	gzfn = fn + ".gz"
+	compress = False
+	if config["defines"].get("gzipoutput") == "true":
+		f = open(newfn, "rb")
+		data = f.read()
+		f.close()
+		compress = True
+		if os.path.exists(fn) and os.path.exists(gzfn):
+			f = open(fn, "rb")
+			compress = (f.read() != data)
+			f.close()
+		if compress:
+			gzf = open(gzfn + ".new", "wb")
+			f = gzip.GzipFile(os.path.basename(fn), "wb", 9, gzf)
+			f.write(data)
+			f.close()
+			gzf.close()
+
+	os.rename(newfn, fn)
+	if compress:
+		os.rename(gzfn + ".new", gzfn)
 
 def config_option(config, name, value):
 	if name == "articlesperpage":
 		global articles_per_page
 		articles_per_page = int(value)
 		return False
+	elif name == "pagenumbering":
+		global page_numbering
+		if value not in ("newest", "stable"):
+			raise ConfigError("pagenumbering must be newest or stable")
+		page_numbering = value
+		return False
 	else:
 		return True
 
+def template_mtimes(config):
+	"""Return the modification times of the templates used for pages."""
+	mtimes = []
+	for option in ("pagetemplate", "itemtemplate"):
+		fn = config[option]
+		if os.path.exists(fn):
+			mtimes.append(os.stat(fn).st_mtime)
+		else:
+			mtimes.append(None)
+	return mtimes
+
+def get_storage(rawdog):
+	return rawdog.get_plugin_storage("org.offog.ats.paged-output")
+
+def article_digest(article):
+	"""Return a digest of the parts of an article that end up on the page,
+	so that a page is only written again when one of them changes."""
+	info = article.entry_info
+	inputs = (article.feed, info.get("link"),
+	          info.get("title_detail", info.get("title")),
+	          info.get("content"),
+	          info.get("summary_detail", info.get("summary")))
+	return hashlib.sha1(repr(inputs)).hexdigest()
+
+def page_fingerprint(config, articles, article_dates, templates, nav):
+	inputs = ([(a.hash, article_digest(a), article_dates[a])
+	           for a in articles],
+	          templates, config["defines"].get("gzipoutput"), nav)
+	return hashlib.sha1(repr(inputs)).hexdigest()
+
+def article_expired(rawdog, config, article, now):
+	pageof = get_storage(rawdog).get("pageof", {})
+	if article.hash in pageof:
+		del pageof[article.hash]
+		rawdog.modified()
+	return True
+
+def stable_pages(rawdog, articles):
+	"""Put any new articles on the head page, starting a new one when it's
+	full, and return a list of (page number, articles), newest first."""
+	storage = get_storage(rawdog)
+	pageof = storage.setdefault("pageof", {})
+	head = storage.get("head", 1)
+
+	new = [a for a in articles if a.hash not in pageof]
+	if new != []:
+		head_count = len([p for p in pageof.values() if p == head])
+		for article in reversed(new):
+			if head_count >= articles_per_page:
+				head += 1
+				head_count = 0
+			pageof[article.hash] = head
+			head_count += 1
+		storage["head"] = head
+		rawdog.modified()
+
+	pages = {}
+	for article in articles:
+		pages.setdefault(pageof[article.hash], []).append(article)
+	numbers = pages.keys()
+	numbers.sort(reverse=True)
+	return [(n, pages[n]) for n in numbers]
+
 def output_write_files(rawdog, config, articles, article_dates):
 	config.log("paged-output starting")
 
@@ -39,48 +160,60 @@ def output_write_files(rawdog, config, articles, article_dates):
 		prefix = outputfile
 		suffix = ""
 
-	chunks = []
-	while articles != []:
-		chunks.append(articles[:articles_per_page])
-		articles = articles[articles_per_page:]
+	if page_numbering == "stable":
+		numbered = stable_pages(rawdog, articles)
+		head = get_storage(rawdog).get("head", 1)
+	else:
+		numbered = []
+		i = 0
+		while articles != []:
+			numbered.append((i, articles[:articles_per_page]))
+			articles = articles[articles_per_page:]
+			i += 1
+		head = 0
 
+	chunks = []
 	fns = []
-	for i in range(len(chunks)):
-		if i == 0:
+	for n, chunk in numbered:
+		if n == head:
 			fn = prefix + suffix
 		else:
-			fn = "%s%d%s" % (prefix, i, suffix)
+			fn = "%s%d%s" % (prefix, n, suffix)
+		chunks.append(chunk)
 		fns.append(fn)
 
+	storage = get_storage(rawdog)
+	fingerprints = storage.setdefault("pages", {})
+	gzipped = (config["defines"].get("gzipoutput") == "true")
+	templates = template_mtimes(config)
+	skipped = 0
+
+	if page_numbering == "stable":
+		choose = min
+	else:
+		choose = max
+	page_dates = [choose([article_dates[a] for a in chunk]) for chunk in chunks]
+
 	for i in range(len(chunks)):
 		fn = fns[i]
-		date = format_time(article_dates[chunks[i][0]], config)
-		config.log("paged-output writing ", fn, " (", date, ")")
-
-		f = StringIO()
-		dw = DayWriter(f, config)
-		for article in chunks[i]:
-			dw.time(article_dates[article])
-			rawdog.write_article(f, article, config)
-		dw.close()
 
-		bits = rawdog.get_main_template_bits(config)
-		bits["items"] = f.getvalue()
-		bits["num_items"] = str(len(rawdog.articles.values()))
+		if page_numbering == "stable" and i != 0:
+			listed = range(max(i - 1, 0), min(i + 2, len(chunks)))
+		else:
+			listed = range(len(chunks))
 
 		f = StringIO()
 		f.write('<ul class="paged_output_pages">\n')
-		for j in range(len(chunks)):
-			latest_date = max([article_dates[a] for a in chunks[j]])
+		for j in listed:
 			f.write('<li>')
 			if i != j:
 				f.write('<a href="' + os.path.basename(fns[j]) + '">')
-			f.write(format_time(latest_date, config))
+			f.write(format_time(page_dates[j], config))
 			if i != j:
 				f.write('</a>')
 			f.write('</li>\n')
 		f.write('</ul>\n')
-		bits["paged_output_pages"] = f.getvalue()
+		pages = f.getvalue()
 
 		f = StringIO()
 		def make_link(rel, page):
@@ -89,16 +222,45 @@ def output_write_files(rawdog, config, articles, article_dates):
 				        % (rel, os.path.basename(fns[page])))
 		make_link("next", i - 1)
 		make_link("prev", i + 1)
-		bits["paged_output_head"] = f.getvalue()
+		nav_head = f.getvalue()
+
+		fingerprint = page_fingerprint(config, chunks[i], article_dates,
+		                               templates, (pages, nav_head))
+		if fingerprints.get(fn) == fingerprint:
+			if (i != 0 and os.path.exists(fn)
+			    and (not gzipped or os.path.exists(fn + ".gz"))):
+				skipped += 1
+				continue
+		else:
+			fingerprints[fn] = fingerprint
+			rawdog.modified()
+
+		date = format_time(article_dates[chunks[i][0]], config)
+		config.log("paged-output writing ", fn, " (", date, ")")
+
+		f = StringIO()
+		dw = DayWriter(f, config)
+		for article in chunks[i]:
+			dw.time(article_dates[article])
+			rawdog.write_article(f, article, config)
+		dw.close()
+
+		bits = rawdog.get_main_template_bits(config)
+		bits["items"] = f.getvalue()
+		bits["num_items"] = str(len(rawdog.articles.values()))
+		bits["paged_output_pages"] = pages
+		bits["paged_output_head"] = nav_head
 
 		s = fill_template(rawdog.get_template(config), bits)
 		f = open(fn + ".new", "w")
 		write_ascii(f, s, config)
 		f.close()
-		os.rename(fn + ".new", fn)
+		replace_output(config, fn)
 
+	config.log("paged-output skipped ", skipped, " unchanged pages")
 	config.log("paged-output done")
 	return False
 
 rawdoglib.plugins.attach_hook("config_option", config_option)
 rawdoglib.plugins.attach_hook("output_write_files", output_write_files)
+rawdoglib.plugins.attach_hook("article_expired", article_expired)
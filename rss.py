@@ -24,24 +24,45 @@
 # This plugin supports the following configuration options:
 #
 # outputxml         RSS output filename
+# outputatom        Atom output filename (if not specified, no Atom feed is
+#                   written)
 # outputfoaf        FOAF output filename
 # outputopml        OPML output filename
 # xmltitle          Feed title (e.g. "Planet Foo")
 # xmllink           Feed link (e.g. "http://planet-foo.example.com/")
 # xmllanguage       Feed language (e.g. "en")
 # xmlurl            URL of the generated RSS (e.g. "http://planet-foo.example.com/rss20.xml")
+# xmlatomurl        URL of the generated Atom feed (e.g. "http://planet-foo.example.com/atom.xml")
 # xmldescription    Feed description (e.g. "People who work on foo")
 # xmlownername      Feed owner's name
 # xmlowneremail     Feed owner's email address
 # xmlmaxarticles    Maximum number of articles to include in the feed
 #                   (defaults to maxarticles if not specified)
+# xmlwriter         How to write the output files: "libxml2" builds each
+#                   document in memory using libxml2, and "stream" writes
+#                   elements to the file as they're generated, producing the
+#                   same output without needing libxml2 (defaults to
+#                   "libxml2" if it's available)
+#
+# Each output file is only regenerated when its inputs (the options above, and
+# the feed list or the articles it contains) have changed since it was last
+# written, so that its modification time stays stable. The converted contents
+# of each article are also cached, so only new or changed articles need to be
+# converted to HTML again; the RSS and Atom feeds share the same conversion,
+# and are written together in a single pass over the articles.
+#
+# If "define gzipoutput true" is set, a gzip-compressed copy of each output file
+# is written alongside it with a .gz suffix.
 #
 # If you're using rawdog to produce a planet page, you'll probably want to have
 # "sortbyfeeddate true" in your config file too.
 
-import os, time, cgi
+import os, re, time, cgi, hashlib, gzip
 import rawdoglib.plugins, rawdoglib.rawdog
-import libxml2
+try:
+    import libxml2
+except ImportError:
+    libxml2 = None
 
 from rawdoglib.rawdog import detail_to_html, string_to_html
 from time import gmtime, strftime
@@ -57,23 +78,189 @@ def rfc822_date(tm):
     return "%s, %02d %s %04d %02d:%02d:%02d GMT" % \
         (days[tm[6]], tm[2], months[tm[1] - 1], tm[0], tm[3], tm[4], tm[5])
 
+def rfc3339_date(tm):
+    """Format a GMT timestamp as returned by time.gmtime() in RFC3339
+    format, as used by Atom."""
+    return "%04d-%02d-%02dT%02d:%02d:%02dZ" % tm[:6]
+
+entity_re = re.compile(r'&(#[0-9]+|#x[0-9a-fA-F]+|[A-Za-z_][A-Za-z0-9._-]*);')
+
+def to_unicode(s):
+    if isinstance(s, unicode):
+        return s
+    return s.decode("utf-8", "replace")
+
+def escape_char(c, specials):
+    """Escape a character the way libxml2 does when writing a document
+    with no declared encoding."""
+    if c in specials:
+        return specials[c]
+    elif ord(c) > 127:
+        return "&#x%X;" % ord(c)
+    else:
+        return c
+
+text_specials = {"<": "&lt;", ">": "&gt;", "&": "&amp;", "\r": "&#13;"}
+attr_specials = {"<": "&lt;", ">": "&gt;", "&": "&amp;", '"': "&quot;",
+                 "\n": "&#10;", "\r": "&#13;", "\t": "&#9;"}
+predefined_entities = {"amp": "&", "lt": "<", "gt": ">", "quot": '"',
+                       "apos": "'"}
+
+def xml_attr(s):
+    """Escape an attribute value, as set with libxml2's setProp."""
+    return "".join([escape_char(c, attr_specials) for c in to_unicode(s)])
+
+def xml_text(s):
+    """Escape element content, as given to libxml2's newChild. Character
+    references and the predefined entities in the content are resolved;
+    other entity references are passed through."""
+    s = to_unicode(s)
+    out = []
+    def add_text(t):
+        out.append("".join([escape_char(c, text_specials) for c in t]))
+    pos = 0
+    for m in entity_re.finditer(s):
+        add_text(s[pos:m.start()])
+        name = m.group(1)
+        if name.startswith("#"):
+            try:
+                if name.startswith("#x"):
+                    add_text(unichr(int(name[2:], 16)))
+                else:
+                    add_text(unichr(int(name[1:])))
+            except ValueError:
+                # Out of range; libxml2 warns about this and carries
+                # on, so pass it through rather than failing the write.
+                out.append(m.group(0))
+        elif name in predefined_entities:
+            add_text(predefined_entities[name])
+        else:
+            out.append(m.group(0))
+        pos = m.end()
+    add_text(s[pos:])
+    return "".join(out).encode("ascii")
+
+def replace_output(config, fn):
+    """Rename the newly-written fn.new to fn. If "define gzipoutput true"
+    is set, also write a gzip-compressed copy alongside it as fn.gz (for
+    web servers' gzip_static support), unless the contents haven't
+    changed since the existing copy was made."""
+    newfn = fn + ".new"
+    gzfn = fn + ".gz"
+    compress = False
+    if config["defines"].get("gzipoutput") == "true":
+        f = open(newfn, "rb")
+        data = f.read()
+        f.close()
+        compress = True
+        if os.path.exists(fn) and os.path.exists(gzfn):
+            f = open(fn, "rb")
+            compress = (f.read() != data)
+            f.close()
+        if compress:
+            gzf = open(gzfn + ".new", "wb")
+            f = gzip.GzipFile(os.path.basename(fn), "wb", 9, gzf)
+            f.write(data)
+            f.close()
+            gzf.close()
+
+    os.rename(newfn, fn)
+    if compress:
+        os.rename(gzfn + ".new", gzfn)
+
+class DOMWriter:
+    """Build an XML document using libxml2, and save it to a temporary
+    file when closed."""
+    def __init__(self, filename):
+        self.filename = filename
+        self.doc = libxml2.newDoc("1.0")
+        self.stack = [self.doc]
+
+    def element(self, tag, text=None, attrs=[]):
+        node = self.stack[-1].newChild(None, tag, text)
+        for name, value in attrs:
+            node.setProp(name, value)
+        return node
+
+    def start(self, tag, attrs=[]):
+        self.stack.append(self.element(tag, None, attrs))
+
+    def end(self):
+        self.stack.pop()
+
+    def close(self):
+        self.doc.saveFormatFile(self.filename + ".new", 1)
+        self.doc.freeDoc()
+
+class StreamWriter:
+    """Write an XML document to a file as it's generated, formatted the
+    same way as libxml2's saveFormatFile, under a temporary name."""
+    def __init__(self, filename):
+        self.filename = filename
+        self.f = open(filename + ".new", "w")
+        self.f.write('<?xml version="1.0"?>\n')
+        # Each entry is [tag, has-children].
+        self.stack = []
+
+    def open_parent(self):
+        if self.stack != [] and not self.stack[-1][1]:
+            self.f.write(">\n")
+            self.stack[-1][1] = True
+
+    def start_tag(self, tag, attrs):
+        self.open_parent()
+        self.f.write("  " * len(self.stack) + "<" + tag)
+        for name, value in attrs:
+            self.f.write(' %s="%s"' % (name, xml_attr(value)))
+
+    def element(self, tag, text=None, attrs=[]):
+        self.start_tag(tag, attrs)
+        if text is None or text == "":
+            self.f.write("/>\n")
+        else:
+            self.f.write(">%s</%s>\n" % (xml_text(text), tag))
+
+    def start(self, tag, attrs=[]):
+        self.start_tag(tag, attrs)
+        self.stack.append([tag, False])
+
+    def end(self):
+        (tag, has_children) = self.stack.pop()
+        if has_children:
+            self.f.write("  " * len(self.stack) + "</" + tag + ">\n")
+        else:
+            self.f.write("/>\n")
+
+    def close(self):
+        self.f.close()
+
 class RSS_Feed:
     def __init__(self):
         self.options = {
             "outputxml": "rss20.xml",
+            "outputatom": "",
             "outputfoaf": "foafroll.xml",
             "outputopml": "opml.xml",
             "xmltitle": "Planet KDE",
             "xmllink": "http://planetKDE.org/",
             "xmllanguage": "en",
             "xmlurl": "http://planetKDE.org/rss20.xml",
+            "xmlatomurl": "http://planetKDE.org/atom.xml",
             "xmldescription": "Planet KDE - http://planetKDE.org/",
             "xmlownername": "Jonathan Riddell",
             "xmlowneremail": "",
             "xmlmaxarticles": "",
+            "xmlwriter": "",
             }
 
     def config_option(self, config, name, value):
+        if name == "xmlwriter":
+            if value not in ("", "libxml2", "stream"):
+                raise rawdoglib.rawdog.ConfigError(
+                    "xmlwriter must be libxml2 or stream")
+            if value == "libxml2" and libxml2 is None:
+                raise rawdoglib.rawdog.ConfigError(
+                    "xmlwriter libxml2 needs the libxml2 Python module")
         if name in self.options:
             self.options[name] = value
             return False
@@ -89,127 +276,361 @@ class RSS_Feed:
         else:
             return feed.get_html_name(config)
 
-    def article_to_xml(self, xml_article, rawdog, config, article):
+    def new_writer(self, filename):
+        """Return a writer for an output file, according to the xmlwriter
+        option."""
+        mode = self.options["xmlwriter"]
+        if mode == "":
+            if libxml2 is None:
+                mode = "stream"
+            else:
+                mode = "libxml2"
+        if mode == "stream":
+            return StreamWriter(filename)
+        else:
+            return DOMWriter(filename)
+
+    def article_data(self, rawdog, config, article):
+        """Convert an article's contents for output, returning a dict
+        that both the RSS and Atom writers use."""
         entry_info = article.entry_info
+        data = {}
 
         id = entry_info.get("id", self.options["xmlurl"] + "#id" + article.hash)
-        guid = xml_article.newChild(None, 'guid', string_to_html(id, config))
-        guid.setProp('isPermaLink', 'false')
+        data["id"] = string_to_html(id, config)
 
         title = self.feed_name(rawdog.feeds[article.feed], config)
         s = detail_to_html(entry_info.get("title_detail"), True, config)
         if s is not None:
             title += ": " + s
-        xml_article.newChild(None, 'title', title)
+        data["title"] = title
 
         if article.date is not None:
-            date = rfc822_date(gmtime(article.date))
-            xml_article.newChild(None, 'pubDate', date)
+            tm = gmtime(article.date)
+            data["pubDate"] = rfc822_date(tm)
+        else:
+            tm = gmtime(article.added)
+            data["pubDate"] = None
+        data["updated"] = rfc3339_date(tm)
 
         s = entry_info.get("link")
         if s is not None and s != "":
-            xml_article.newChild(None, 'link', string_to_html(s, config))
+            data["link"] = s
+            data["link_html"] = string_to_html(s, config)
+        else:
+            data["link"] = None
 
+        data["description"] = None
         for key in ["content", "summary_detail"]:
             s = detail_to_html(entry_info.get(key), False, config)
             if s is not None:
-                xml_article.newChild(None, 'description', s)
+                data["description"] = s
                 break
 
-        return True
-
-    def write_rss(self, rawdog, config, articles):
-        doc = libxml2.newDoc("1.0")
-
-        rss = doc.newChild(None, 'rss', None)
-        rss.setProp('version', "2.0")
-        rss.setProp('xmlns:dc', "http://purl.org/dc/elements/1.1/")
-        rss.setProp('xmlns:atom', 'http://www.w3.org/2005/Atom')
-
-        channel = rss.newChild(None, 'channel', None)
-        channel.newChild(None, 'title', self.options["xmltitle"])
-        channel.newChild(None, 'link', self.options["xmllink"])
-        channel.newChild(None, 'language', self.options["xmllanguage"])
-        channel.newChild(None, 'description', self.options["xmldescription"])
-
-        atom_link = channel.newChild(None, 'atom:link', None)
-        atom_link.setProp('href', self.options["xmlurl"])
-        atom_link.setProp('rel', 'self')
-        atom_link.setProp('type', 'application/rss+xml')
+        return data
 
-        try:
-            maxarticles = int(self.options["xmlmaxarticles"])
-        except ValueError:
-            maxarticles = len(articles)
-        for article in articles[:maxarticles]:
-            xml_article = channel.newChild(None, 'item', None)
-            self.article_to_xml(xml_article, rawdog, config, article)
+    def content_digest(self, article):
+        """Return a digest of the parts of an article that article_data
+        uses, so that edits are noticed even if the feed doesn't give
+        the article a new date or "updated" element."""
+        entry_info = article.entry_info
+        parts = [entry_info.get(key) for key in
+                 ("id", "link", "title_detail", "content", "summary_detail")]
+        return hashlib.sha1(repr(parts)).hexdigest()
+
+    def cached_data(self, rawdog, config, article):
+        """Return an article's converted contents from the cache,
+        converting the article if it's new or has changed since it was
+        cached."""
+        storage = rawdog.get_plugin_storage("org.offog.ats.rss")
+        cache = storage.setdefault("items", {})
+
+        marker = (article.date, article.entry_info.get("updated"),
+                  self.content_digest(article),
+                  self.feed_name(rawdog.feeds[article.feed], config),
+                  self.options["xmlurl"])
+        cached = cache.get(article.hash)
+        if cached is not None and cached[0] == marker:
+            return cached[1]
+
+        data = self.article_data(rawdog, config, article)
+        cache[article.hash] = (marker, data)
+        rawdog.modified()
+        return data
+
+    def article_to_rss(self, w, data):
+        w.start('item')
+        w.element('guid', data["id"], [('isPermaLink', 'false')])
+        w.element('title', data["title"])
+        if data["pubDate"] is not None:
+            w.element('pubDate', data["pubDate"])
+        if data["link"] is not None:
+            w.element('link', data["link_html"])
+        if data["description"] is not None:
+            w.element('description', data["description"])
+        w.end()
+
+    def article_to_atom(self, w, data):
+        w.start('entry')
+        w.element('id', data["id"])
+        w.element('title', data["title"], [('type', 'html')])
+        w.element('updated', data["updated"])
+        if data["link"] is not None:
+            w.element('link', None, [('href', data["link"])])
+        if data["description"] is not None:
+            w.element('content', data["description"], [('type', 'html')])
+        w.end()
+
+    def article_expired(self, rawdog, config, article, now):
+        cache = rawdog.get_plugin_storage("org.offog.ats.rss").get("items")
+        if cache is not None and article.hash in cache:
+            del cache[article.hash]
+            rawdog.modified()
+        return True
 
-        doc.saveFormatFile(self.options["outputxml"], 1)
-        doc.freeDoc()
+    def start_rss(self):
+        w = self.new_writer(self.options["outputxml"])
+
+        w.start('rss', [
+            ('version', "2.0"),
+            ('xmlns:dc', "http://purl.org/dc/elements/1.1/"),
+            ('xmlns:atom', 'http://www.w3.org/2005/Atom'),
+            ])
+
+        w.start('channel')
+        w.element('title', self.options["xmltitle"])
+        w.element('link', self.options["xmllink"])
+        w.element('language', self.options["xmllanguage"])
+        w.element('description', self.options["xmldescription"])
+
+        w.element('atom:link', None, [
+            ('href', self.options["xmlurl"]),
+            ('rel', 'self'),
+            ('type', 'application/rss+xml'),
+            ])
+
+        return w
+
+    def start_atom(self, articles):
+        w = self.new_writer(self.options["outputatom"])
+
+        w.start('feed', [
+            ('xmlns', 'http://www.w3.org/2005/Atom'),
+            ('xml:lang', self.options["xmllanguage"]),
+            ])
+        w.element('title', self.options["xmltitle"])
+        w.element('subtitle', self.options["xmldescription"])
+        w.element('link', None, [('href', self.options["xmllink"])])
+        w.element('link', None, [
+            ('href', self.options["xmlatomurl"]),
+            ('rel', 'self'),
+            ('type', 'application/atom+xml'),
+            ])
+        w.element('id', self.options["xmlatomurl"])
+
+        if articles == []:
+            updated = time.time()
+        else:
+            updated = max([a.date or a.added for a in articles])
+        w.element('updated', rfc3339_date(gmtime(updated)))
+
+        w.start('author')
+        w.element('name', self.options["xmlownername"])
+        if self.options["xmlowneremail"] != "":
+            w.element('email', self.options["xmlowneremail"])
+        w.end()
+
+        return w
+
+    def write_feeds(self, rawdog, config, articles, rss, atom):
+        """Write the RSS and/or Atom feeds, converting each article once
+        for both."""
+        if rss:
+            rss = self.start_rss()
+        if atom:
+            atom = self.start_atom(articles)
+
+        for article in articles:
+            data = self.cached_data(rawdog, config, article)
+            if rss:
+                self.article_to_rss(rss, data)
+            if atom:
+                self.article_to_atom(atom, data)
+
+        if rss:
+            rss.end()
+            rss.end()
+            rss.close()
+            replace_output(config, rss.filename)
+        if atom:
+            atom.end()
+            atom.close()
+            replace_output(config, atom.filename)
 
     def write_foaf(self, rawdog, config):
-        doc = libxml2.newDoc("1.0")
+        w = self.new_writer(self.options["outputfoaf"])
 
-        xml = doc.newChild(None, 'rdf:RDF', None)
-        xml.setProp('xmlns:rdf', "http://www.w3.org/1999/02/22-rdf-syntax-ns#")
-        xml.setProp('xmlns:rdfs', "http://www.w3.org/2000/01/rdf-schema#")
-        xml.setProp('xmlns:foaf', "http://xmlns.com/foaf/0.1/")
-        xml.setProp('xmlns:rss', "http://purl.org/rss/1.0/")
-        xml.setProp('xmlns:dc', "http://purl.org/dc/elements/1.1/")
+        w.start('rdf:RDF', [
+            ('xmlns:rdf', "http://www.w3.org/1999/02/22-rdf-syntax-ns#"),
+            ('xmlns:rdfs', "http://www.w3.org/2000/01/rdf-schema#"),
+            ('xmlns:foaf', "http://xmlns.com/foaf/0.1/"),
+            ('xmlns:rss', "http://purl.org/rss/1.0/"),
+            ('xmlns:dc', "http://purl.org/dc/elements/1.1/"),
+            ])
 
-        group = xml.newChild(None, 'foaf:Group', None)
-        group.newChild(None, 'foaf:name', self.options["xmltitle"])
-        group.newChild(None, 'foaf:homepage', self.options["xmllink"])
+        w.start('foaf:Group')
+        w.element('foaf:name', self.options["xmltitle"])
+        w.element('foaf:homepage', self.options["xmllink"])
 
-        seeAlso = group.newChild(None, 'rdfs:seeAlso', None)
-        seeAlso.setProp('rdf:resource', '')
+        w.element('rdfs:seeAlso', None, [('rdf:resource', '')])
 
         for url in sorted(rawdog.feeds.keys()):
-            member = group.newChild(None, 'foaf:member', None)
-
-            agent = member.newChild(None, 'foaf:Agent', None)
-            agent.newChild(None, 'foaf:name', self.feed_name(rawdog.feeds[url], config))
-            weblog = agent.newChild(None, 'foaf:weblog', None)
-            document = weblog.newChild(None, 'foaf:Document', None)
-            document.setProp('rdf:about', url)
-            seealso = document.newChild(None, 'rdfs:seeAlso', None)
-            channel = seealso.newChild(None, 'rss:channel', None)
-            channel.setProp('rdf:about', '')
-
-        doc.saveFormatFile(self.options["outputfoaf"], 1)
-        doc.freeDoc()
+            w.start('foaf:member')
+
+            w.start('foaf:Agent')
+            w.element('foaf:name', self.feed_name(rawdog.feeds[url], config))
+            w.start('foaf:weblog')
+            w.start('foaf:Document', [('rdf:about', url)])
+            w.start('rdfs:seeAlso')
+            w.element('rss:channel', None, [('rdf:about', '')])
+            w.end()
+            w.end()
+            w.end()
+            w.end()
+
+            w.end()
+
+        w.end()
+        w.end()
+        w.close()
+        replace_output(config, w.filename)
 
     def write_opml(self, rawdog, config):
-        doc = libxml2.newDoc("1.0")
+        w = self.new_writer(self.options["outputopml"])
 
-        xml = doc.newChild(None, 'opml', None)
-        xml.setProp('version', "1.1")
+        w.start('opml', [('version', "1.1")])
 
-        head = xml.newChild(None, 'head', None)
-        head.newChild(None, 'title', self.options["xmltitle"])
+        w.start('head')
+        w.element('title', self.options["xmltitle"])
         now = rfc822_date(gmtime())
-        head.newChild(None, 'dateCreated', now)
-        head.newChild(None, 'dateModified', now)
-        head.newChild(None, 'ownerName', self.options["xmlownername"])
-        head.newChild(None, 'ownerEmail', self.options["xmlowneremail"])
+        w.element('dateCreated', now)
+        w.element('dateModified', now)
+        w.element('ownerName', self.options["xmlownername"])
+        w.element('ownerEmail', self.options["xmlowneremail"])
+        w.end()
 
-        body = xml.newChild(None, 'body', None)
+        w.start('body')
         for url in sorted(rawdog.feeds.keys()):
-            outline = body.newChild(None, 'outline', None)
-            outline.setProp('text', self.feed_name(rawdog.feeds[url], config))
-            outline.setProp('xmlUrl', url)
-
-        doc.saveFormatFile(self.options["outputopml"], 1)
-        doc.freeDoc()
+            w.element('outline', None, [
+                ('text', self.feed_name(rawdog.feeds[url], config)),
+                ('xmlUrl', url),
+                ])
+        w.end()
+
+        w.end()
+        w.close()
+        replace_output(config, w.filename)
+
+    def unchanged(self, rawdog, config, option, inputs):
+        """Return True if the file named by option (and its .gz copy, if
+        gzipoutput is set) already exists and was generated from the same
+        inputs; otherwise, remember the inputs' fingerprint for next time
+        and return False."""
+        filename = self.options[option]
+        gzipoutput = config["defines"].get("gzipoutput")
+        inputs = (sorted(self.options.items()), gzipoutput, inputs)
+        fingerprint = hashlib.sha1(repr(inputs)).hexdigest()
+
+        exists = os.path.exists(filename)
+        if gzipoutput == "true":
+            exists = exists and os.path.exists(filename + ".gz")
+
+        storage = rawdog.get_plugin_storage("org.offog.ats.rss")
+        if exists and storage.get(option) == fingerprint:
+            config.log("rss: ", filename, " unchanged")
+            return True
+        storage[option] = fingerprint
+        rawdog.modified()
+        return False
 
     def output_write(self, rawdog, config, articles):
-        self.write_rss(rawdog, config, articles)
-        self.write_foaf(rawdog, config)
-        self.write_opml(rawdog, config)
+        try:
+            maxarticles = int(self.options["xmlmaxarticles"])
+        except ValueError:
+            maxarticles = len(articles)
+        articles = articles[:maxarticles]
+
+        # Each item's title starts with its feed's name.
+        inputs = [(a.hash, a.date, self.content_digest(a),
+                   self.feed_name(rawdog.feeds[a.feed], config))
+                  for a in articles]
+        rss = not self.unchanged(rawdog, config, "outputxml", inputs)
+        atom = (self.options["outputatom"] != ""
+                and not self.unchanged(rawdog, config, "outputatom", inputs))
+        if rss or atom:
+            self.write_feeds(rawdog, config, articles, rss, atom)
+
+        inputs = [(url, self.feed_name(rawdog.feeds[url], config))
+                  for url in sorted(rawdog.feeds.keys())]
+        if not self.unchanged(rawdog, config, "outputfoaf", inputs):
+            self.write_foaf(rawdog, config)
+        if not self.unchanged(rawdog, config, "outputopml", inputs):
+            self.write_opml(rawdog, config)
 
         return True
 
 rss_feed = RSS_Feed()
 rawdoglib.plugins.attach_hook("config_option", rss_feed.config_option)
 rawdoglib.plugins.attach_hook("output_write", rss_feed.output_write)
+rawdoglib.plugins.attach_hook("article_expired", rss_feed.article_expired)
+
+def benchmark(count, prefix):
+    """Write an RSS document with count items using each writer, printing
+    how long each took, and check that they produced the same output."""
+    description = ('<p>Some <b>HTML</b> with an &amp; entity, a caf\xc3\xa9 '
+                   'and a &#233; reference</p>\n') * 20
+    outputs = []
+    for name, writer in (("libxml2", DOMWriter), ("stream", StreamWriter)):
+        if name == "libxml2" and libxml2 is None:
+            print "%-8s skipped (libxml2 isn't available)" % name
+            continue
+        fn = prefix + "." + name
+        start = time.time()
+        w = writer(fn)
+        w.start('rss', [('version', '2.0')])
+        w.start('channel')
+        w.element('title', 'Benchmark & "test"')
+        for i in range(count):
+            w.start('item')
+            w.element('title', 'Item %d &lt;%d&gt;' % (i, i))
+            w.element('guid', 'http://example.org/%d?a=1&b=2' % i,
+                      [('isPermaLink', 'false')])
+            w.element('description', description)
+            w.end()
+        w.end()
+        w.end()
+        w.close()
+        os.rename(fn + ".new", fn)
+        print "%-8s %.3fs" % (name, time.time() - start)
+        outputs.append(fn)
+    if len(outputs) == 2:
+        data = [open(fn).read() for fn in outputs]
+        if data[0] == data[1]:
+            print "outputs are identical"
+        else:
+            print "outputs differ"
+            return False
+    return True
+
+if __name__ == "__main__":
+    # Usage: python rss.py benchmark [items]
+    import sys
+    if len(sys.argv) not in (2, 3) or sys.argv[1] != "benchmark":
+        print >>sys.stderr, "Usage: rss.py benchmark [items]"
+        sys.exit(1)
+    if len(sys.argv) == 3:
+        count = int(sys.argv[2])
+    else:
+        count = 10000
+    if not benchmark(count, "rss-benchmark.xml"):
+        sys.exit(1)
@@ -4,8 +4,11 @@
 # FIXME: as of rawdog 2.15, this now uses different logic from rawdog itself to
 # identify timeouts, etc.; it may be better to add another hook to capture the
 # actual status rawdog reports.
+#
+# If "define gzipoutput true" is set, a gzip-compressed copy of the HTML status
+# page is written alongside it with a .gz suffix.
 
-import rawdoglib.plugins, time, threading, re, os
+import rawdoglib.plugins, time, threading, re, os, gzip
 
 display_as = [
 	(r"ok-3.*", "#afffaf"),
@@ -16,6 +19,34 @@ display_as = [
 	(None, "#7fffff"),
 	]
 
+def replace_output(config, fn):
+	"""Rename the newly-written fn.new to fn. If "define gzipoutput true"
+	is set, also write a gzip-compressed copy alongside it as fn.gz (for
+	web servers' gzip_static support), unless the contents haven't
+	changed since the existing copy was made."""
+	newfn = fn + ".new"
+	gzfn = fn + ".gz"
+	compress = False
+	if config["defines"].get("gzipoutput") == "true":
+		f = open(newfn, "rb")
+		data = f.read()
+		f.close()
+		compress = True
+		if os.path.exists(fn) and os.path.exists(gzfn):
+			f = open(fn, "rb")
+			compress = (f.read() != data)
+			f.close()
+		if compress:
+			gzf = open(gzfn + ".new", "wb")
+			f = gzip.GzipFile(os.path.basename(fn), "wb", 9, gzf)
+			f.write(data)
+			f.close()
+			gzf.close()
+
+	os.rename(newfn, fn)
+	if compress:
+		os.rename(gzfn + ".new", gzfn)
+
 class StatusLogPlugin:
 	def __init__(self):
 		self.lock = threading.Lock()
@@ -133,8 +164,7 @@ class StatusLogPlugin:
 
 		f.close()
 
-		newfn = self.outputfile + ".new"
-		f = open(newfn, "w")
+		f = open(self.outputfile + ".new", "w")
 		f.write("""<!DOCTYPE HTML PUBLIC "-//W3C//DTD HTML 4.01//EN"
    "http://www.w3.org/TR/html4/strict.dtd">
 <html lang="en">
@@ -196,7 +226,7 @@ class StatusLogPlugin:
 </html>
 """)
 		f.close()
-		os.rename(newfn, self.outputfile)
+		replace_output(config, self.outputfile)
 
 		return True
 
@@ -13,8 +13,252 @@
 # them, which'll make the formatting a bit nicer if you're aiming for very
 # short descriptions:
 #   killtags true
+#
+# The limit counts the characters that'll be visible, so tags don't count
+# (unless they're being removed, in which case each one is replaced by a
+# space), and an entity like "&amp;" counts as one character. Any elements
+# that are still open where the description is cut are closed again. The
+# description is only read as far as the cut, so very long articles don't
+# cost much more to truncate than short ones.
+#
+# To limit how much space a feed's articles take up in rawdog's state file,
+# give it a "storebudget" argument, which is a number of bytes:
+#   storebudget 8192
+#
+# If the text in an article (in any of its fields) comes to more than that,
+# duplicate copies of the content and summary are dropped first, then the
+# biggest fields that rawdog and these plugins don't use, and then the
+# content and summary are truncated until the article fits. Fields you want
+# to keep can be listed in a "storekeep" argument:
+#   storekeep tags source
+# (The archive plugin writes out whichever fields are left, so if you're
+# using it, list any others you want archived here.)
+#
+# The number of bytes saved for each feed is logged when rawdog finishes.
+
+import rawdoglib.plugins, re, time
+
+# A "<" is only the start of a tag if it's followed straight away by a
+# name, "/", "!" or "?"; otherwise, as in "a < b", it's just text. Comments
+# and CDATA sections run to their own terminators, since they may contain
+# ">" (as in "<!--[if !IE]>-->").
+token_re = re.compile(r'<!--.*?(?:-->|\Z)|<!\[CDATA\[.*?(?:\]\]>|\Z)'
+                      r'|<[A-Za-z/!?][^>]*>?|&(?:#\w+|\w+);', re.S)
+tag_name_re = re.compile(r'</?([A-Za-z][-:\w]*)')
+
+# Elements that don't have closing tags.
+void_elements = set(["area", "base", "br", "col", "embed", "hr", "img",
+                     "input", "link", "meta", "param", "source", "track",
+                     "wbr"])
+
+def is_comment(token):
+	return token.startswith("<!--") or token.startswith("<![CDATA[")
+
+def is_complete(token):
+	"""Return True if a tag, comment or CDATA section token has its
+	terminator."""
+	if token.startswith("<!--"):
+		return len(token) >= 7 and token.endswith("-->")
+	elif token.startswith("<![CDATA["):
+		return len(token) >= 12 and token.endswith("]]>")
+	return token.endswith(">")
+
+def has_more_text(html, pos):
+	"""Return True if there's any visible text (or a broken tag) in html
+	after pos."""
+	while pos < len(html):
+		m = token_re.search(html, pos)
+		if m is None:
+			return html[pos:].strip() != ""
+		token = m.group()
+		if (html[pos:m.start()].strip() != "" or token.startswith("&")
+		    or not is_complete(token)):
+			return True
+		pos = m.end()
+	return False
+
+def truncate_html(html, n, killtags):
+	"""Truncate html to n visible characters (or don't truncate it if n is
+	0), closing any elements left open, and add "..." if anything was
+	cut off. If killtags is set, replace tags with spaces."""
+	out = []
+	stack = []
+	count = 0
+	pos = 0
+	cut = False
+	while pos < len(html) and (n == 0 or count < n):
+		m = token_re.search(html, pos)
+		if m is None:
+			start = len(html)
+		else:
+			start = m.start()
+		if start > pos:
+			text = html[pos:start]
+			if n != 0 and count + len(text) > n:
+				text = text[:n - count]
+			out.append(text)
+			count += len(text)
+			pos += len(text)
+			continue
+
+		token = m.group()
+		if token.startswith("&"):
+			out.append(token)
+			count += 1
+		elif is_comment(token):
+			# Comments take up no space. An unterminated one would
+			# hide everything after the article, so it's dropped.
+			if not is_complete(token):
+				cut = True
+				break
+			if not killtags:
+				out.append(token)
+		elif killtags:
+			out.append(" ")
+			count += 1
+		elif not token.endswith(">"):
+			# An unterminated tag runs to the end; keep it only if
+			# it fits, rather than breaking it in half.
+			if n != 0 and count + len(token) > n:
+				cut = True
+				break
+			out.append(token)
+			count += len(token)
+		else:
+			out.append(token)
+			name = tag_name_re.match(token)
+			if name is not None:
+				name = name.group(1).lower()
+				if token.startswith("</"):
+					if name in stack:
+						i = len(stack) - 1 - stack[::-1].index(name)
+						del stack[i:]
+				elif not token.endswith("/>") and name not in void_elements:
+					stack.append(name)
+		pos = m.end()
+
+	if cut or (pos < len(html) and has_more_text(html, pos)):
+		out = ["".join(out).rstrip(), "..."]
+		for name in reversed(stack):
+			out.append("</" + name + ">")
+	elif pos < len(html):
+		# Only tags and whitespace are left, so keep them.
+		if killtags:
+			out.append(token_re.sub(" ", html[pos:]))
+		else:
+			out.append(html[pos:])
+	return "".join(out)
+
+# Fields that rawdog or the plugins here use, which storebudget won't drop.
+used_fields = set(["author", "author_detail", "content", "created",
+                   "created_parsed", "description",
+                   "download_articles_local_copy", "enclosures",
+                   "guidislink", "id", "link", "links", "published",
+                   "published_parsed", "slash_department", "slash_section",
+                   "summary", "summary_detail", "title", "title_detail",
+                   "title_raw", "updated", "updated_parsed",
+                   "watchlist_matches"])
+
+def text_size(value, seen):
+	"""Return the number of bytes of text in value, counting each string
+	object only once (as pickle will when it's saved)."""
+	if isinstance(value, basestring):
+		if id(value) in seen:
+			return 0
+		seen.add(id(value))
+		if isinstance(value, unicode):
+			return len(value.encode("utf-8"))
+		return len(value)
+	elif isinstance(value, dict):
+		return sum([text_size(v, seen) for v in value.values()])
+	elif isinstance(value, (list, tuple)):
+		return sum([text_size(v, seen) for v in value])
+	return 0
 
-import rawdoglib.plugins, re
+def info_size(ei):
+	return text_size(ei, set())
+
+def share_copies(ei):
+	"""Make fields that duplicate other fields share the same string, and
+	drop duplicate content entries and summaries."""
+	for field in ("title", "summary"):
+		# feedparser makes "title" a copy of the title_detail's value;
+		# it may be out of date if the detail's been truncated.
+		detail = ei.get(field + "_detail")
+		if isinstance(detail, dict) and field in ei and "value" in detail:
+			ei[field] = detail["value"]
+
+	if "content" in ei:
+		values = set()
+		content = []
+		for detail in ei["content"]:
+			if detail.get("value") not in values:
+				values.add(detail.get("value"))
+				content.append(detail)
+		ei["content"] = content
+		summary = ei.get("summary_detail")
+		if isinstance(summary, dict) and summary.get("value") in values:
+			del ei["summary_detail"]
+			if "summary" in ei:
+				del ei["summary"]
+
+def drop_unused(ei, budget, keep):
+	"""Drop the biggest unused fields until ei fits in budget."""
+	sizes = []
+	for field, value in ei.items():
+		if field not in used_fields and field not in keep:
+			sizes.append((text_size(value, set()), field))
+	sizes.sort(reverse=True)
+	for size, field in sizes:
+		if info_size(ei) <= budget:
+			break
+		del ei[field]
+
+def shrink_text(ei, budget, killtags):
+	"""Truncate the content and summary, biggest first, until ei fits in
+	budget."""
+	details = list(ei.get("content", []))
+	if "summary_detail" in ei:
+		details.append(ei["summary_detail"])
+	details = [(text_size(d["value"], set()), d) for d in details if "value" in d]
+	details.sort(reverse=True)
+	for size, detail in details:
+		over = info_size(ei) - budget
+		if over <= 0:
+			break
+		target = max(size - over, 0)
+		# Markup doesn't count towards the limit, and characters can
+		# take more than one byte, so guess at the limit and refine it.
+		n = target
+		value = ""
+		for i in range(8):
+			if n <= 0:
+				value = ""
+				break
+			value = truncate_html(detail["value"], n, killtags).strip()
+			got = text_size(value, set())
+			if got <= target:
+				break
+			n = n * target / got
+		detail["value"] = value
+	if "summary_detail" in ei and "summary" in ei:
+		ei["summary"] = ei["summary_detail"]["value"]
+
+# Maps feed URLs to [articles shrunk, bytes saved].
+savings = {}
+
+def apply_budget(url, ei, budget, keep, killtags):
+	"""Shrink ei to fit in budget bytes, recording what was saved."""
+	before = info_size(ei)
+	if before <= budget:
+		return
+	share_copies(ei)
+	drop_unused(ei, budget, keep)
+	if info_size(ei) > budget:
+		shrink_text(ei, budget, killtags)
+	stats = savings.setdefault(url, [0, 0])
+	stats[0] += 1
+	stats[1] += before - info_size(ei)
 
 def article_seen(rawdog, config, article, ignore):
 	fargs = rawdog.feeds[article.feed].args
@@ -22,18 +266,9 @@ def article_seen(rawdog, config, article, ignore):
 	killtags = fargs.get("killtags", False) == "true"
 
 	def process(detail, n):
-		v = detail["value"]
-		if killtags:
-			v = re.sub(r'<[^>]*>', ' ', v)
-		if n != 0 and len(v) > n:
-			# Don't break a tag in half.
-			l = v.rfind("<", 0, n)
-			r = v.rfind(">", 0, n)
-			if l != -1 and r < l:
-				n = l
-
-			v = v[:n].rstrip() + "..."
-		detail["value"] = v.strip()
+		if n != 0 or killtags:
+			detail["value"] = truncate_html(detail["value"], n, killtags)
+		detail["value"] = detail["value"].strip()
 
 	ei = article.entry_info
 	if "content" in ei:
@@ -42,6 +277,49 @@ def article_seen(rawdog, config, article, ignore):
 	if "summary_detail" in ei:
 		process(ei["summary_detail"], n)
 
+	if "storebudget" in fargs:
+		keep = set(fargs.get("storekeep", "").split())
+		apply_budget(article.feed, ei, int(fargs["storebudget"]), keep, killtags)
+
+	return True
+
+def shutdown(rawdog, config):
+	for url, (articles, saved) in sorted(savings.items()):
+		config.log("truncate: ", url, ": saved ", saved, " bytes in ",
+		           articles, " articles")
 	return True
 
 rawdoglib.plugins.attach_hook("article_seen", article_seen)
+rawdoglib.plugins.attach_hook("shutdown", shutdown)
+
+def benchmark(count):
+	"""Truncate a content list of count entries to 200 characters, for
+	entries of increasing size, printing how long it took and how long
+	stripping all the tags from the entries (as killtags used to) took.
+	The truncation time shouldn't grow with the size of the entries."""
+	para = ('<p>Some <b>bold</b> text, an <a href="http://example.org/">link'
+	        '</a> &amp; an entity.<!-- a comment --></p>\n')
+	for size in (10, 100, 1000):
+		value = para * (size * 1024 / len(para))
+		content = [{"value": value} for i in range(count)]
+		start = time.time()
+		for detail in content:
+			truncate_html(detail["value"], 200, False)
+		truncated = time.time() - start
+		start = time.time()
+		for detail in content:
+			re.sub(r'<[^>]*>', ' ', detail["value"])[:200]
+		stripped = time.time() - start
+		print "%5dKB x %d: truncate %.3fs, strip all tags %.3fs" \
+		      % (size, count, truncated, stripped)
+
+if __name__ == "__main__":
+	# Usage: python truncate.py benchmark [entries]
+	import sys
+	if len(sys.argv) not in (2, 3) or sys.argv[1] != "benchmark":
+		print >>sys.stderr, "Usage: truncate.py benchmark [entries]"
+		sys.exit(1)
+	if len(sys.argv) == 3:
+		benchmark(int(sys.argv[2]))
+	else:
+		benchmark(100)
@@ -1,6 +1,36 @@
 # Copyright 2005 BAM
-
-import os, time, cgi
+#
+# Options are given as defines in the rawdog config:
+#
+# define outputxml FILE   archive filename (default output.xml.gz)
+# define xmljournal true  don't rewrite the archive on every run; instead
+#                         write this run's new and updated feeds and
+#                         articles as a small record in FILE.journal/.
+#                         Run "python xml_archiver.py compact [FILE]" to
+#                         fold the records back into FILE; a run without
+#                         xmljournal also folds them in.
+# define xmlvalidate always
+#                         validate the archive against the schema on every
+#                         run. By default, validation is skipped when the
+#                         file matches the FILE.sig signature written
+#                         alongside it last time.
+# define xmlshard true    keep each feed's entry and articles in its own
+#                         file under FILE.shards/, listed in
+#                         FILE.shards/manifest. Only the shards for feeds
+#                         touched during a run are loaded and written.
+#                         The first run with this on splits an existing
+#                         FILE (and its journal) into shards; FILE is
+#                         left in place but no longer updated. "python
+#                         xml_archiver.py shard [FILE]" does the same by
+#                         hand, for feeds that don't have a shard yet.
+# define xmlcompress N    gzip compression level, 0 (none) to 9 (default 9)
+# define xmlbackground false
+#                         write the archive at shutdown. By default, the
+#                         write starts in a background thread when rawdog
+#                         starts generating output (the output_filter
+#                         hook), overlapping with it.
+
+import os, sys, time, cgi, hashlib, threading
 import rawdoglib.plugins, rawdoglib.rawdog
 import libxml2
 
@@ -86,47 +116,192 @@ schema_xml = """
 
 class XML_Archiver_Exception(Exception): pass
 
-class XML_Archiver:
-    def __init__(self, rawdog, config):
-        if config['defines'].has_key('outputxml'):
-            self.out_file = config['defines']['outputxml']
-        else:
-            self.out_file = 'output.xml.gz'
-        self.doc_open()
-
-        self.xml_feeds = self.xml.xpathEval('/rawdog/feeds')[0]
-        self.xml_articles = self.xml.xpathEval('/rawdog/articles')[0]
-
-        self.xml.setProp('last', str(time.time()))
-        self.sync_bits(self.xml, config['defines'].items())
+def journal_dir(out_file):
+    """Return the directory holding the journal records for out_file."""
+    return out_file + '.journal'
+
+rng_schema = None
+def schema_parser():
+    """Return the compiled RelaxNG schema, compiling it on first use."""
+    global rng_schema
+    if rng_schema is None:
+        schema = libxml2.parseMemory(schema_xml, len(schema_xml))
+        rng_schema = schema.relaxNGNewDocParserCtxt().relaxNGParse()
+    return rng_schema
+
+def shard_dir(out_file):
+    """Return the directory holding the per-feed shards for out_file."""
+    return out_file + '.shards'
+
+def shard_file(out_file, feed_id):
+    """Return the filename of feed_id's shard of out_file."""
+    return os.path.join(shard_dir(out_file),
+                        hashlib.sha1(feed_id).hexdigest() + '.xml.gz')
+
+def read_manifest(out_file):
+    """Return a dict mapping feed ids to shard filenames."""
+    manifest = {}
+    try:
+        f = open(os.path.join(shard_dir(out_file), 'manifest'))
+    except IOError:
+        return manifest
+    for l in f.readlines():
+        (fn, id) = l.rstrip('\n').split(' ', 1)
+        manifest[id] = os.path.join(shard_dir(out_file), fn)
+    f.close()
+    return manifest
+
+def write_manifest(out_file, manifest):
+    fn = os.path.join(shard_dir(out_file), 'manifest')
+    f = open(fn + '.new', 'w')
+    for id, shard in sorted(manifest.items()):
+        f.write('%s %s\n' % (os.path.basename(shard), id))
+    f.close()
+    os.rename(fn + '.new', fn)
+
+def signature_file(filename):
+    return filename + '.sig'
+
+def file_signature(filename):
+    """Return a string identifying the contents of a file: its size,
+    mtime and SHA-1 digest."""
+    st = os.stat(filename)
+    h = hashlib.sha1()
+    f = open(filename, 'rb')
+    while 1:
+        block = f.read(65536)
+        if block == '':
+            break
+        h.update(block)
+    f.close()
+    return '%d %d %s' % (st.st_size, int(st.st_mtime), h.hexdigest())
+
+def signature_matches(filename):
+    """Return True if filename is exactly the file we last wrote."""
+    try:
+        f = open(signature_file(filename))
+        sig = f.read().strip()
+        f.close()
+    except IOError:
+        return False
+
+    # Compare the cheap fields before hashing the file.
+    st = os.stat(filename)
+    if sig.split(' ')[:2] != [str(st.st_size), str(int(st.st_mtime))]:
+        return False
+    return sig == file_signature(filename)
+
+def parse_archive(filename, validate='changed'):
+    """Parse an archive document or journal record, validating it
+    unless validate is 'changed' and it hasn't changed since we wrote
+    it."""
+    doc = libxml2.parseFile(filename)
+    if validate == 'changed' and signature_matches(filename):
+        return doc
+
+    ctxt = schema_parser().relaxNGNewValidCtxt()
+    if doc.relaxNGValidateDoc(ctxt) is not 0:
+        doc.freeDoc()
+        raise XML_Archiver_Exception("Can't parse old XML: " + filename)
+    return doc
+
+def write_doc(doc, filename, compress=9):
+    """Write out a document atomically, along with its signature."""
+    doc.setDocCompressMode(compress)
+    doc.saveFormatFile(filename + '.new', 1)
+    os.rename(filename + '.new', filename)
+
+    f = open(signature_file(filename) + '.new', 'w')
+    f.write(file_signature(filename) + '\n')
+    f.close()
+    os.rename(signature_file(filename) + '.new', signature_file(filename))
+
+def remove_doc(filename):
+    """Remove a document and its signature."""
+    os.unlink(filename)
+    try:
+        os.unlink(signature_file(filename))
+    except OSError:
+        pass
+
+class XML_Archive:
+    """An archive document, with its feeds, articles and bits indexed by
+    id."""
+    def __init__(self, out_file):
+        self.out_file = out_file
+        self.validate = 'changed'
+        self.compress = 9
+        self.records = []
 
     def doc_open(self):
         if os.path.isfile(self.out_file):
-            schema = libxml2.parseMemory(schema_xml, len(schema_xml))
-            rngp = schema.relaxNGNewDocParserCtxt().relaxNGParse()
-            ctxt = rngp.relaxNGNewValidCtxt()
-
-            self.doc = libxml2.parseFile(self.out_file)
-            if self.doc.relaxNGValidateDoc(ctxt) is 0:
-                self.xml = self.doc.children
-            else:
-                raise XML_Archiver_Exception("Can't parse old XML: "
-                                             + self.out_file)
-
+            self.doc = parse_archive(self.out_file, self.validate)
+            self.xml = self.doc.children
+            self.doc_index()
         else:
-            self.doc = libxml2.newDoc("1.0")
-            self.xml = self.doc.newChild(None, 'rawdog', None)
-            self.xml.newChild(None, 'feeds', None)
-            self.xml.newChild(None, 'articles', None)
+            self.doc_new()
+
+        # Fold in any journal records left by earlier runs; they're
+        # removed once the merged document has been written.
+        self.records = self.journal_records()
+        for fn in self.records:
+            record = parse_archive(fn, self.validate)
+            self.merge(record)
+            record.freeDoc()
+
+    def doc_new(self):
+        self.doc = libxml2.newDoc("1.0")
+        self.xml = self.doc.newChild(None, 'rawdog', None)
+        self.xml.newChild(None, 'feeds', None)
+        self.xml.newChild(None, 'articles', None)
+        self.doc_index()
+
+    def doc_index(self):
+        self.xml_feeds = self.xml.xpathEval('/rawdog/feeds')[0]
+        self.xml_articles = self.xml.xpathEval('/rawdog/articles')[0]
 
-    def sync_bits(self, parent, items):
+        # Index the existing nodes once, so that the hooks below don't have
+        # to scan the whole archive with XPath for every feed and article.
+        self.feed_nodes = self.index_children(self.xml_feeds, 'feed', 'id')
+        self.article_nodes = self.index_children(self.xml_articles,
+                                                 'article', 'id')
+        self.bit_nodes = {}
+
+    def journal_records(self):
+        """Return the journal record filenames for this archive, oldest
+        first."""
+        dn = journal_dir(self.out_file)
+        if not os.path.isdir(dn):
+            return []
+        fns = [fn for fn in os.listdir(dn) if fn.endswith('.xml.gz')]
+        fns.sort()
+        return [os.path.join(dn, fn) for fn in fns]
+
+    def index_children(self, parent, name, key):
+        """Return a dict mapping the key attribute of each name child
+        element of parent to the element."""
+        index = {}
+        child = parent.children
+        while child is not None:
+            if child.type == 'element' and child.name == name:
+                index[child.prop(key)] = child
+            child = child.next
+        return index
+
+    def sync_bits(self, owner, parent, items):
+        """Set the bit children of parent from items. owner identifies
+        parent in the bit index: None for the root, or a (kind, id)
+        pair for a feed or an article."""
+        if not self.bit_nodes.has_key(owner):
+            self.bit_nodes[owner] = self.index_children(parent, 'bit', 'name')
+        bits = self.bit_nodes[owner]
         for name, value in items:
-            bit = parent.xpathEval('bit[@name="' + name + '"]')
-            if len(bit) is 0:
+            if bits.has_key(name):
+                bit = bits[name]
+            else:
                 bit = parent.newChild(None, 'bit', None)
                 bit.setProp('name', name)
-            else:
-                bit = bit[0]
+                bits[name] = bit
             bit.setContent(value)
     def describe(self, parent, description):
         xml_d = parent.xpathEval('describe')
@@ -135,48 +310,186 @@ class XML_Archiver:
         else:
             xml_d[0].setContent(description)
 
+    def feed_node(self, id):
+        """Return the feed element with the given id, creating it if it
+        isn't already in the archive."""
+        if self.feed_nodes.has_key(id):
+            return self.feed_nodes[id]
+        xml_feed = self.xml_feeds.newChild(None, 'feed', None)
+        self.feed_nodes[id] = xml_feed
+        return xml_feed
+
+    def article_node(self, id):
+        """Return the article element with the given id, creating it if
+        it isn't already in the archive."""
+        if self.article_nodes.has_key(id):
+            return self.article_nodes[id]
+        xml_article = self.xml_articles.newChild(None, 'article', None)
+        self.article_nodes[id] = xml_article
+        return xml_article
+
+    def merge_node(self, owner, dst, src):
+        """Copy the attributes, description and bits of src onto dst."""
+        prop = src.properties
+        while prop is not None:
+            dst.setProp(prop.name, prop.content)
+            prop = prop.next
+        # Element content comes back unescaped, but describe() and
+        # sync_bits() expect escaped text.
+        bits = []
+        child = src.children
+        while child is not None:
+            if child.type == 'element':
+                if child.name == 'describe':
+                    self.describe(dst, cgi.escape(child.content))
+                elif child.name == 'bit':
+                    bits.append((child.prop('name'),
+                                 cgi.escape(child.content)))
+            child = child.next
+        self.sync_bits(owner, dst, bits)
+
+    def merge(self, record):
+        """Merge a journal record document into this archive."""
+        xml = record.children
+        self.merge_node(None, self.xml, xml)
+
+        feeds = xml.xpathEval('/rawdog/feeds')[0]
+        for id, node in self.index_children(feeds, 'feed', 'id').items():
+            self.merge_node(('feed', id), self.feed_node(id), node)
+
+        articles = xml.xpathEval('/rawdog/articles')[0]
+        for id, node in self.index_children(articles, 'article', 'id').items():
+            self.merge_node(('article', id), self.article_node(id), node)
+
+    def write_archive(self):
+        """Write the whole archive, and drop the journal records that
+        have been merged into it."""
+        write_doc(self.doc, self.out_file, self.compress)
+        for fn in self.records:
+            remove_doc(fn)
+        self.records = []
+
+    def write_record(self):
+        """Write this run's changes as a new journal record."""
+        dn = journal_dir(self.out_file)
+        if not os.path.isdir(dn):
+            os.makedirs(dn)
+        fn = os.path.join(dn, '%017.6f-%d.xml.gz' % (time.time(), os.getpid()))
+        write_doc(self.doc, fn, self.compress)
+
+    def close(self):
+        self.doc.freeDoc()
+
+class XML_Archiver:
+    def __init__(self, rawdog, config):
+        defines = config['defines']
+        if defines.has_key('outputxml'):
+            self.out_file = defines['outputxml']
+        else:
+            self.out_file = 'output.xml.gz'
+        self.validate = defines.get('xmlvalidate', 'changed')
+        self.compress = int(defines.get('xmlcompress', '9'))
+        self.background = defines.get('xmlbackground', 'true') == 'true'
+        self.defines = defines.items()
+        self.last = str(time.time())
+
+        # In journal mode, only this run's changes are kept in memory
+        # and written out; "compact" folds them into the archive later.
+        self.journal = defines.get('xmljournal', 'false') == 'true'
+
+        # In shard mode, each feed's archive is opened the first time
+        # the feed is touched.
+        self.shard = defines.get('xmlshard', 'false') == 'true'
+        self.archives = {}
+        self.writer = None
+        self.writer_error = None
+        # A journal record is only worth writing if a hook changed
+        # something; otherwise the archive is rewritten every run, which
+        # also folds in any journal records.
+        self.dirty = not self.journal
+        if self.shard:
+            manifest_file = os.path.join(shard_dir(self.out_file), 'manifest')
+            if (not os.path.exists(manifest_file)
+                and (os.path.isfile(self.out_file)
+                     or os.path.isdir(journal_dir(self.out_file)))):
+                count = split_archive(self.out_file, self.validate,
+                                      self.compress)
+                config.log("xml_archiver: split ", self.out_file, " into ",
+                           count, " shards")
+            self.manifest = read_manifest(self.out_file)
+            self.manifest_changed = False
+        else:
+            self.archives[None] = self.open_archive(self.out_file)
+
+    def open_archive(self, out_file):
+        archive = XML_Archive(out_file)
+        archive.validate = self.validate
+        archive.compress = self.compress
+        if self.journal:
+            archive.doc_new()
+        else:
+            archive.doc_open()
+
+        archive.xml.setProp('last', self.last)
+        archive.sync_bits(None, archive.xml, self.defines)
+        return archive
+
+    def archive(self, feed_id):
+        """Return the archive that holds feed_id's feed and articles,
+        ready to be modified."""
+        # Don't change the documents under a background write; they'll be
+        # written again at shutdown.
+        self.finish_write()
+        self.dirty = True
+
+        if not self.shard:
+            return self.archives[None]
+        if not self.archives.has_key(feed_id):
+            if not self.manifest.has_key(feed_id):
+                dn = shard_dir(self.out_file)
+                if not os.path.isdir(dn):
+                    os.makedirs(dn)
+                self.manifest[feed_id] = shard_file(self.out_file, feed_id)
+                self.manifest_changed = True
+            self.archives[feed_id] = self.open_archive(self.manifest[feed_id])
+        return self.archives[feed_id]
+
 
     def feed_sync(self, rawdog, config, feed, feed_data, error, non_fatal):
         feed_info = feed_data["feed"]
-        xml_feed = self.xml_feeds.xpathEval('feed[@id="' +
-                                            feed.get_id(config) + '"]')
-        if len(xml_feed) is 0:
-            xml_feed = self.xml_feeds.newChild(None, 'feed', None)
-        else:
-            xml_feed = xml_feed[0]
+        feed_id = feed.get_id(config)
+        archive = self.archive(feed_id)
+        xml_feed = archive.feed_node(feed_id)
 
         if feed_info.has_key('description'):
-            self.describe(xml_feed, feed_info['description'])
+            archive.describe(xml_feed, feed_info['description'])
         else:
-            self.describe(xml_feed, '')
+            archive.describe(xml_feed, '')
 
         xml_feed.setProp('title', feed_info['title_detail']['value'])
         xml_feed.setProp('link', feed.url)
-        xml_feed.setProp('id', feed.get_id(config))
+        xml_feed.setProp('id', feed_id)
         xml_feed.setProp('update_last', str(feed.last_update))
         xml_feed.setProp('update_next', str(feed.last_update + feed.period))
         xml_feed.setProp('period', str(feed.period))
-        self.sync_bits(xml_feed, feed.args.items())
+        archive.sync_bits(('feed', feed_id), xml_feed, feed.args.items())
 
         return True
 
 
     def article_add(self, rawdog, config, article, now):
-        xml_article = self.xml_articles.newChild(None, 'article', None)
-        self.__article_sync(xml_article, rawdog, config, article)
+        self.__article_sync(rawdog, config, article)
 
     def article_sync(self, rawdog, config, article, now):
-        xml_article = self.xml_articles.xpathEval('article[@id="' +
-                                                  article.hash + '"]')
-        if len(xml_article) is 0:
-            xml_article = self.xml_articles.newChild(None, 'article', None)
-        else:
-            xml_article = xml_article[0]
-        self.__article_sync(xml_article, rawdog, config, article)
-    def __article_sync(self, xml_article, rawdog, config, article):
+        self.__article_sync(rawdog, config, article)
+    def __article_sync(self, rawdog, config, article):
+        feed_id = rawdog.feeds[article.feed].get_id(config)
+        archive = self.archive(feed_id)
+        xml_article = archive.article_node(article.hash)
+
         entry_info = article.entry_info
         xml_article.setProp('id', article.hash)
-        xml_article.setProp('feed', rawdog.feeds[article.feed].get_id(config))
+        xml_article.setProp('feed', feed_id)
         xml_article.setProp('title', entry_info['title_raw'])
         xml_article.setProp('date', str(article.date))
         xml_article.setProp('last_seen', str(article.last_seen))
@@ -190,26 +503,132 @@ class XML_Archiver:
         elif entry_info.has_key('summary_detail'):
             content = entry_info['summary_detail']['value']
         content = cgi.escape(content).encode('utf8', 'ignore')
-        self.describe(xml_article, content)
+        archive.describe(xml_article, content)
 
         articles = rawdog.articles
         if articles.has_key('HACK_sekkrit_flags'):
             if articles['HACK_sekkrit_flags'].has_key(article.hash):
-            self.sync_bits(xml_article,
-                           articles['HACK_sekkrit_flags'][article.hash].items())
+                archive.sync_bits(('article', article.hash), xml_article,
+                                  articles['HACK_sekkrit_flags'][article.hash].items())
 
         return True
 
 
-    def __write(self):
-        self.doc.setDocCompressMode(9)
-        self.doc.saveFormatFile(self.out_file, 1)
-        self.doc.freeDoc()
+    def write_all(self, config):
+        self.dirty = False
+        start = time.time()
+        for archive in self.archives.values():
+            if self.journal:
+                archive.write_record()
+            else:
+                archive.write_archive()
+        if self.shard and self.manifest_changed:
+            write_manifest(self.out_file, self.manifest)
+            self.manifest_changed = False
+        config.log("xml_archiver: wrote ", len(self.archives), " files in ",
+                   "%.2f" % (time.time() - start), "s")
+
+    def background_write(self, config):
+        try:
+            self.write_all(config)
+        except:
+            self.writer_error = sys.exc_info()
+
+    def start_write(self, rawdog, config, articles):
+        """Start writing the archive in the background once rawdog
+        begins generating output, since no more updates will happen."""
+        if self.background and self.writer is None and self.dirty:
+            config.log("xml_archiver: starting background write")
+            self.writer = threading.Thread(target=self.background_write,
+                                           args=(config,))
+            self.writer.start()
+        return True
+
+    def finish_write(self):
+        """Wait for any background write to complete."""
+        if self.writer is None:
+            return
+        self.writer.join()
+        self.writer = None
+        if self.writer_error is not None:
+            (t, v, tb) = self.writer_error
+            self.writer_error = None
+            raise t, v, tb
+
     def write(self, rawdog, config):
-        self.__write()
+        start = time.time()
+        self.finish_write()
+        if self.dirty:
+            self.write_all(config)
+        for archive in self.archives.values():
+            archive.close()
+        config.log("xml_archiver: shutdown took ",
+                   "%.2f" % (time.time() - start), "s")
         return True
 
 
+def split_archive(out_file, validate='changed', compress=9):
+    """Copy the feeds and articles in out_file (and its journal records)
+    into per-feed shards, for feeds that don't have a shard yet, and
+    return the number of shards written. out_file is left in place."""
+    archive = XML_Archive(out_file)
+    archive.validate = validate
+    archive.doc_open()
+    manifest = read_manifest(out_file)
+
+    shards = {}
+    def shard(feed_id):
+        if not shards.has_key(feed_id):
+            manifest[feed_id] = shard_file(out_file, feed_id)
+            shards[feed_id] = XML_Archive(manifest[feed_id])
+            shards[feed_id].compress = compress
+            shards[feed_id].doc_new()
+            shards[feed_id].merge_node(None, shards[feed_id].xml, archive.xml)
+        return shards[feed_id]
+
+    # Existing shards are newer than out_file, so they're left alone.
+    old = dict(manifest)
+    for id, node in archive.feed_nodes.items():
+        if not old.has_key(id):
+            s = shard(id)
+            s.merge_node(('feed', id), s.feed_node(id), node)
+    for id, node in archive.article_nodes.items():
+        feed_id = node.prop('feed')
+        if not old.has_key(feed_id):
+            s = shard(feed_id)
+            s.merge_node(('article', id), s.article_node(id), node)
+
+    dn = shard_dir(out_file)
+    if not os.path.isdir(dn):
+        os.makedirs(dn)
+    for s in shards.values():
+        s.write_archive()
+        s.close()
+    write_manifest(out_file, manifest)
+
+    # Fold out_file's journal records into it, so they're not split again.
+    if archive.records != []:
+        archive.write_archive()
+    archive.close()
+    return len(shards)
+
+def compact(out_file):
+    """Fold the journal records for out_file and for each of its shards
+    into the archives themselves."""
+    fns = []
+    if os.path.isfile(out_file) or os.path.isdir(journal_dir(out_file)):
+        fns.append(out_file)
+    if os.path.isdir(shard_dir(out_file)):
+        fns += read_manifest(out_file).values()
+
+    count = 0
+    for fn in fns:
+        archive = XML_Archive(fn)
+        archive.doc_open()
+        count += len(archive.records)
+        archive.write_archive()
+        archive.close()
+    return count
 
 xml_archiver = {}
 def startup(rawdog, config):
@@ -217,6 +636,68 @@ def startup(rawdog, config):
     rawdoglib.plugins.attach_hook("feed_fetched", xml_archiver.feed_sync)
     rawdoglib.plugins.attach_hook("article_added", xml_archiver.article_add)
     rawdoglib.plugins.attach_hook("article_updated", xml_archiver.article_sync)
+    rawdoglib.plugins.attach_hook("output_filter", xml_archiver.start_write)
     rawdoglib.plugins.attach_hook("shutdown", xml_archiver.write)
     return True
 rawdoglib.plugins.attach_hook("startup", startup)
+
+def benchmark(max_count, updates=1000):
+    """Build in-memory archives of increasing size, up to max_count
+    articles, and time updating the same number of articles in each, the
+    way the feed_fetched and article_updated hooks do. With the indexes,
+    the time per update shouldn't grow with the size of the archive."""
+    count = 1000
+    while count <= max_count:
+        archive = XML_Archive('unused')
+        archive.doc_new()
+        start = time.time()
+        for i in range(count):
+            xml_article = archive.article_node('a%d' % i)
+            xml_article.setProp('id', 'a%d' % i)
+            xml_article.setProp('feed', 'f%d' % (i % 100))
+            archive.describe(xml_article, 'Article %d' % i)
+        build = time.time() - start
+
+        step = max(count // updates, 1)
+        start = time.time()
+        for i in range(0, step * updates, step):
+            feed_id = 'f%d' % (i % 100)
+            archive.feed_node(feed_id).setProp('id', feed_id)
+            xml_article = archive.article_node('a%d' % (i % count))
+            xml_article.setProp('title', 'Updated article %d' % i)
+            xml_article.setProp('last_seen', str(time.time()))
+            archive.describe(xml_article, 'Updated content %d' % i)
+            archive.sync_bits(('article', 'a%d' % (i % count)), xml_article,
+                              [('flag', 'yes'), ('seen', str(i))])
+        update = time.time() - start
+        archive.close()
+
+        print "%7d articles: built in %.3fs, %d updates in %.3fs (%.1fus each)" \
+              % (count, build, updates, update, update * 1e6 / updates)
+        count *= 10
+
+if __name__ == '__main__':
+    # Usage: python xml_archiver.py compact [outputxml]
+    #        python xml_archiver.py shard [outputxml]
+    #        python xml_archiver.py benchmark [articles]
+    if len(sys.argv) not in (2, 3) or sys.argv[1] not in ('compact', 'shard',
+                                                          'benchmark'):
+        print >>sys.stderr, "Usage: xml_archiver.py compact [outputxml]"
+        print >>sys.stderr, "       xml_archiver.py shard [outputxml]"
+        print >>sys.stderr, "       xml_archiver.py benchmark [articles]"
+        sys.exit(1)
+    if sys.argv[1] == 'benchmark':
+        if len(sys.argv) == 3:
+            benchmark(int(sys.argv[2]))
+        else:
+            benchmark(100000)
+        sys.exit(0)
+    if len(sys.argv) == 3:
+        out_file = sys.argv[2]
+    else:
+        out_file = 'output.xml.gz'
+    if sys.argv[1] == 'shard':
+        print "Split %s into %d shards" % (out_file, split_archive(out_file))
+    else:
+        print "Compacted %d journal records into %s" % (compact(out_file),
+                                                        out_file)